@@ -0,0 +1,305 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import scipy
+import sklearn
+from sklearn.covariance import LedoitWolf
+from RiskModel import RiskModel
+from DataLoader import PricePanel
+from Profiler import Profiler
+from Optimizer_SR import fit_alloc, error_fct, assess_portfolio, assess_portfolios, backtest_portfolio, SharpeObjective, efficient_frontier
+
+def synthetic_returns(n, T, num_factors=4, seed=0):
+    """
+    Synthetic daily returns (T, n) from a seeded multi-factor model.
+
+    A market factor (~16% annual vol) with betas around 1, num_factors - 1 sector factors (~10% annual vol)
+    each loading on a block of stocks, and idiosyncratic noise (~20-35% annual vol), giving stock vols of
+    roughly 25-40% and average pairwise correlations of 0.2-0.3.
+    """
+    rng = np.random.default_rng(seed)
+    daily = np.sqrt(252)
+
+    market = rng.normal(0.08 / 252, 0.16 / daily, (T, 1))
+    betas = rng.normal(1.0, 0.3, (1, n))
+    sectors = rng.normal(0, 0.10 / daily, (T, num_factors - 1))
+    sector_of = rng.integers(0, num_factors - 1, n)
+    loadings = np.zeros((num_factors - 1, n))
+    loadings[sector_of, np.arange(n)] = rng.uniform(0.5, 1.5, n)
+    idio_vol = rng.uniform(0.20, 0.35, n) / daily
+    alpha = rng.normal(0.02 / 252, 0.05 / 252, n)
+
+    return alpha + market * betas + np.matmul(sectors, loadings) + rng.normal(0, 1, (T, n)) * idio_vol
+
+def synthetic_prices(n, T, seed=0, benchmark_ticker=None):
+    """
+    Synthetic daily prices (T+1, n) compounding synthetic_returns, for offline benchmarks.
+    With benchmark_ticker, an equal-weight index of the stocks is appended under that name.
+    """
+    returns = synthetic_returns(n, T, seed=seed)
+    columns = [f'S{i:04d}' for i in range(n)]
+    if benchmark_ticker is not None:
+        returns = np.hstack([returns, returns.mean(axis=1, keepdims=True)])
+        columns.append(benchmark_ticker)
+    prices = 100 * np.vstack([np.ones(returns.shape[1]), np.cumprod(1 + returns, axis=0)])
+    index = pd.bdate_range('2000-01-03', periods=T + 1, name='Date')
+    return pd.DataFrame(prices, index=index, columns=pd.Index(columns, name='Ticker'))
+
+def _time(fn, repeat):
+    """
+    Run fn repeat times, return the timings in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def _record(stage, n, T, timings, **extra):
+    record = {
+        "stage": stage,
+        "n": n,
+        "T": T,
+        "repeat": len(timings),
+        "seconds_min": min(timings),
+        "seconds_mean": float(np.mean(timings)),
+    }
+    record.update(extra)
+    print(f"{stage:<40} n={n:<5} T={T:<5} min {record['seconds_min']:.4f}s mean {record['seconds_mean']:.4f}s")
+    return record
+
+def benchmark_hot_paths(n, T, repeat=3, seed=0):
+    """
+    Time the risk-model, optimizer and assessment hot paths on one synthetic (T, n) sample
+    """
+    prices = synthetic_prices(n, T, seed)
+    returns = prices.pct_change().dropna().values
+    cov_matrix = np.cov(returns, rowvar=False)
+    allocs = fit_alloc(prices, cov_matrix)
+    rm = RiskModel()
+
+    records = []
+    for shrink_target_method in ['identity', 'avgcorr']:
+        timings = _time(lambda: rm.shrinkage_covariance(returns, shrink_target_method=shrink_target_method), repeat)
+        records.append(_record(f"shrinkage_covariance[{shrink_target_method}]", n, T, timings))
+        timings = _time(lambda: rm.blocked_shrinkage_covariance(returns, shrink_target_method=shrink_target_method, block_size=252), repeat)
+        records.append(_record(f"blocked_shrinkage_covariance[{shrink_target_method}]", n, T, timings))
+    records.append(_record("LedoitWolf", n, T, _time(lambda: LedoitWolf().fit(returns), repeat)))
+    # the four risk models of a sweep on the same window, one at a time vs from shared moments
+    records.append(_record("four_estimators", n, T, _time(lambda: (
+        np.cov(returns, rowvar=False), rm.shrinkage_covariance(returns, 'identity'), rm.shrinkage_covariance(returns, 'avgcorr'),
+        LedoitWolf().fit(returns)), repeat)))
+    records.append(_record("covariance_estimators", n, T, _time(lambda: rm.covariance_estimators(returns), repeat)))
+    if T > 252:
+        # one-year windows stepping by a month, one at a time vs batched
+        windows = [(start, start + 252) for start in range(0, T - 252 + 1, 21)]
+        for shrink_target_method in ['identity', 'avgcorr']:
+            timings = _time(lambda: [rm.shrinkage_covariance(returns[start:end], shrink_target_method=shrink_target_method)
+                                     for start, end in windows], repeat)
+            records.append(_record(f"window_loop[{shrink_target_method}]", n, T, timings, num_windows=len(windows)))
+            timings = _time(lambda: rm.batch_shrinkage_covariance(returns, windows, shrink_target_method=shrink_target_method), repeat)
+            records.append(_record(f"batch_shrinkage_covariance[{shrink_target_method}]", n, T, timings, num_windows=len(windows)))
+    for solver in ['SLSQP', 'QP']:
+        records.append(_record(f"fit_alloc[{solver}]", n, T, _time(lambda: fit_alloc(prices, cov_matrix, solver=solver), repeat)))
+    factor_cov = rm.factor_covariance(returns, num_factors=4)
+    records.append(_record("factor_covariance[k=4]", n, T, _time(lambda: rm.factor_covariance(returns, num_factors=4), repeat)))
+    records.append(_record("fit_alloc[QP,factor]", n, T, _time(lambda: fit_alloc(prices, factor_cov, solver='QP'), repeat)))
+    records.append(_record("fit_alloc[QP,factor dense]", n, T, _time(lambda: fit_alloc(prices, factor_cov.to_dense(), solver='QP'), repeat)))
+    records.append(_record("assess_portfolio", n, T, _time(lambda: assess_portfolio(prices, allocs, cov_matrix), repeat)))
+    candidates = np.random.default_rng(seed).dirichlet(np.ones(n), size=100)
+    records.append(_record("assess_portfolios[K=100]", n, T, _time(lambda: assess_portfolios(prices, candidates, cov_matrix), repeat)))
+    records.append(_record("efficient_frontier[K=100]", n, T,
+                           _time(lambda: efficient_frontier(returns.mean(axis=0), cov_matrix, num_points=100), repeat)))
+    records.append(_record("efficient_frontier[K=100,long-only]", n, T,
+                           _time(lambda: efficient_frontier(returns.mean(axis=0), cov_matrix, num_points=100, long_only=True), repeat)))
+    return records
+
+def benchmark_backtest(n, T, risk_matrix='LedoitWolf', shrink_target_method='identity', window_size_month=12,
+                       solver='SLSQP', repeat=1, seed=0):
+    """
+    Time a full backtest_portfolio run over T synthetic days, with the price loader stubbed by a PricePanel
+    """
+    prices = synthetic_prices(n, T, seed, benchmark_ticker='SPY')
+    panel = PricePanel(prices)
+    tickers = list(prices.columns[:-1])
+    sd = prices.index[0] + pd.DateOffset(months=window_size_month)
+    sd = prices.index[prices.index.searchsorted(sd)].strftime("%Y-%m-%d")
+    ed = (prices.index[-1] + pd.DateOffset(days=1)).strftime("%Y-%m-%d")
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # backtest_portfolio writes its per-window CSV to result/, keep it out of the real results
+        os.chdir(tmp)
+        os.makedirs('result')
+        try:
+            timings = _time(lambda: backtest_portfolio(sd, ed, tickers, risk_matrix, shrink_target_method, window_size_month,
+                                                       benchmark_ticker='SPY', solver=solver, panel=panel), repeat)
+        finally:
+            os.chdir(cwd)
+
+    stage = f"backtest_portfolio[{risk_matrix}{'+' + shrink_target_method if shrink_target_method else ''},{solver}]"
+    return [_record(stage, n, T, timings, window_size_month=window_size_month)]
+
+def benchmark_reoptimization(n, T, reopt_metric='frobenius', thresholds=None, risk_matrix='LedoitWolf',
+                             shrink_target_method='identity', window_size_month=12, solver='SLSQP', seed=0):
+    """
+    Drift-triggered re-optimization (backtest_portfolio's reopt_threshold) against re-solving every window,
+    on T synthetic days: skipped solves, solver time and the differences of the back-test metrics
+
+    thresholds: Optional, reopt_threshold values (default: 0.25, 0.4, 0.5 for 'frobenius', whose monthly drift is
+        dominated by the noise of the mean returns, and 0.02, 0.05, 0.1 for 'sharpe')
+    """
+    if thresholds is None:
+        thresholds = (0.25, 0.4, 0.5) if reopt_metric == 'frobenius' else (0.02, 0.05, 0.1)
+    prices = synthetic_prices(n, T, seed, benchmark_ticker='SPY')
+    panel = PricePanel(prices)
+    tickers = list(prices.columns[:-1])
+    sd = prices.index[0] + pd.DateOffset(months=window_size_month)
+    sd = prices.index[prices.index.searchsorted(sd)].strftime("%Y-%m-%d")
+    ed = (prices.index[-1] + pd.DateOffset(days=1)).strftime("%Y-%m-%d")
+    metrics = ["cumulative_return", "annualized_return", "std_dev", "sharpe_ratio", "information_ratio"]
+    # Solver time of each run from its profiler records, the per-window results keep no wall-clock timings
+    profilers = [Profiler() for _ in (None,) + tuple(thresholds)]
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.makedirs('result')
+        try:
+            runs = [backtest_portfolio(sd, ed, tickers, risk_matrix, shrink_target_method, window_size_month, benchmark_ticker='SPY',
+                                       solver=solver, panel=panel, return_results=True, reopt_threshold=threshold,
+                                       reopt_metric=reopt_metric, profiler=profiler)
+                    for threshold, profiler in zip((None,) + tuple(thresholds), profilers)]
+        finally:
+            os.chdir(cwd)
+
+    full = runs[0][:len(metrics)]
+    solve_seconds = [float(profiler.to_frame()['optimize_time'].sum()) for profiler in profilers]
+    records = []
+    for threshold, run, seconds in zip(thresholds, runs[1:], solve_seconds[1:]):
+        lazy, windows = run[:len(metrics)], run[6]
+        stage = f"reoptimization[{reopt_metric}<{threshold}]"
+        records.append(_record(stage, n, T, [seconds],
+                               full_solve_seconds=solve_seconds[0],
+                               num_windows=len(windows),
+                               skipped_solves=int((~windows['Reoptimized']).sum()),
+                               **{f"{metric}_difference": float(value - full_value)
+                                  for metric, value, full_value in zip(metrics, lazy, full)}))
+        record = records[-1]
+        print(f"{'':<40} skipped {record['skipped_solves']} of {record['num_windows']} solves, "
+              f"Sharpe ratio difference {record['sharpe_ratio_difference']:+.4f}")
+    return records
+
+def benchmark_fit_alloc(n=100, T=1260, seed=0):
+    """
+    Time one rolling-window solve of fit_alloc: pandas error_fct with finite differences vs SharpeObjective
+    with exact gradient (SLSQP) vs the active-set QP solver.
+    """
+    prices = synthetic_prices(n, T, seed)
+    cov_matrix = np.cov(prices.pct_change().dropna().values, rowvar=False)
+
+    start = time.perf_counter()
+    allocs_legacy = fit_alloc(prices, cov_matrix, error_fct)
+    time_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    allocs = fit_alloc(prices, cov_matrix)
+    time_analytic = time.perf_counter() - start
+
+    start = time.perf_counter()
+    allocs_qp = fit_alloc(prices, cov_matrix, solver='QP')
+    time_qp = time.perf_counter() - start
+
+    objective = SharpeObjective(prices.values, cov_matrix)
+    result = {
+        "n": n,
+        "T": T,
+        "Legacy Time (s)": time_legacy,
+        "Analytic Time (s)": time_analytic,
+        "QP Time (s)": time_qp,
+        "Speedup": time_legacy / time_analytic,
+        "Max Allocation Difference": np.abs(allocs_legacy - allocs).max(),
+        "Sharpe Ratio Difference": objective(allocs_legacy)[0] - objective(allocs)[0],
+        "QP Max Allocation Difference": np.abs(allocs_qp - allocs).max(),
+    }
+    print(f"fit_alloc n={n} T={T}: legacy {time_legacy:.3f}s, analytic {time_analytic:.3f}s, QP {time_qp:.3f}s, speedup {result['Speedup']:.1f}x")
+    return result
+
+def benchmark_precision(n, T, dtype=np.float32, solver='SLSQP', repeat=3, seed=0):
+    """
+    Accuracy report of the reduced-precision risk model against float64 on one synthetic (T, n) sample
+
+    For each shrink target: timings in both precisions, the shrinkage intensity delta, the relative Frobenius
+    error of the covariance matrix and the drift of the optimal allocations (max and L1) with the resulting
+    Sharpe ratio loss, measured with the float64 covariance.
+    """
+    prices = synthetic_prices(n, T, seed)
+    returns = prices.pct_change().dropna().values
+    name = np.dtype(dtype).name
+
+    records = []
+    for shrink_target_method in ['identity', 'avgcorr']:
+        rm, rm_reduced = RiskModel(), RiskModel(dtype)
+        timings = _time(lambda: rm.shrinkage_covariance(returns, shrink_target_method=shrink_target_method), repeat)
+        timings_reduced = _time(lambda: rm_reduced.shrinkage_covariance(returns, shrink_target_method=shrink_target_method), repeat)
+        S_hat, _, beta_hat, _ = rm.shrinkage_covariance(returns, shrink_target_method=shrink_target_method)
+        S_hat_reduced, _, beta_hat_reduced, _ = rm_reduced.shrinkage_covariance(returns, shrink_target_method=shrink_target_method)
+
+        allocs = fit_alloc(prices, S_hat, solver=solver)
+        allocs_reduced = fit_alloc(prices, S_hat_reduced, solver=solver)
+        objective = SharpeObjective(prices.values, S_hat)
+
+        records.append(_record(f"precision[{shrink_target_method},{name}]", n, T, timings_reduced,
+                               float64_seconds_min=min(timings),
+                               speedup=min(timings) / min(timings_reduced),
+                               shrinkage_delta=float(abs(beta_hat_reduced - beta_hat)),
+                               frobenius_error=float(np.linalg.norm(S_hat_reduced - S_hat) / np.linalg.norm(S_hat)),
+                               allocation_drift_max=float(np.abs(allocs_reduced - allocs).max()),
+                               allocation_drift_l1=float(np.abs(allocs_reduced - allocs).sum()),
+                               sharpe_ratio_loss=float(objective(allocs)[0] - objective(allocs_reduced)[0])))
+        record = records[-1]
+        print(f"{'':<40} speedup {record['speedup']:.2f}x, shrinkage delta {record['shrinkage_delta']:.2e}, "
+              f"Frobenius error {record['frobenius_error']:.2e}, allocation drift {record['allocation_drift_max']:.2e}")
+    return records
+
+def run_benchmarks(ns=(30, 100, 500), Ts=(252, 1260, 2520), repeat=3, backtest=True, precision=True, output='benchmark_results.json'):
+    """
+    Run the offline benchmark suite over n x T and write the timings as JSON to output
+
+    :return:
+        dict with the environment ("meta") and one record per stage, n and T ("results")
+    """
+    records = []
+    for n in ns:
+        for T in Ts:
+            records.extend(benchmark_hot_paths(n, T, repeat))
+            if precision:
+                records.extend(benchmark_precision(n, T, repeat=repeat))
+            if backtest and T > 252:
+                records.extend(benchmark_backtest(n, T))
+
+    report = {
+        "meta": {
+            "timestamp": pd.Timestamp.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "scipy": scipy.__version__,
+            "sklearn": sklearn.__version__,
+        },
+        "results": records,
+    }
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to {output}")
+    return report
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -1,37 +1,283 @@
-import yfinance as yf
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
 
-def get_stock_data(tickers, start_date, end_date):
+# Local on-disk price cache: one columnar .npz file per ticker
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_cache')
+PRICE_FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume']
+# Market cap snapshot (ticker -> (cap, fetch time)) and file-backed cap history
+MARKET_CAP_SNAPSHOT = 'market_caps.json'
+MARKET_CAP_TTL = 24 * 60 * 60
+MARKET_CAP_HISTORY = os.path.join(CACHE_DIR, 'market_cap_history.csv')
+# Cached S&P 500 ticker list, so runs do not scrape slickcharts on every start
+UNIVERSE_FILE = os.path.join(CACHE_DIR, 'sp500_tickers.json')
+# Point-in-time S&P 500 membership table (ticker, start, end), built from a saved snapshot
+MEMBERSHIP_FILE = os.path.join(CACHE_DIR, 'sp500_membership.csv')
+
+def _cache_path(cache_dir, ticker):
+    return os.path.join(cache_dir, f'{ticker}.npz')
+
+def _load_cached_prices(cache_dir, ticker):
     """
-    Fetch adjusted close prices for the given tickers from Yahoo Finance.
+    Load the cached price history of a ticker.
+
+    :return:
+        (prices, covered_start, covered_end) or None if the ticker is not cached.
+        [covered_start, covered_end) is the date range already requested from Yahoo Finance.
+    """
+    path = _cache_path(cache_dir, ticker)
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path, allow_pickle=False) as f:
+        prices = pd.DataFrame(f['values'], index=pd.DatetimeIndex(f['dates'], name='Date'), columns=list(f['fields']))
+        return prices, pd.Timestamp(f['start'][()]), pd.Timestamp(f['end'][()])
+
+def _save_cached_prices(cache_dir, ticker, prices, covered_start, covered_end):
+    """
+    Write the price history of a ticker to the cache (atomically, so concurrent readers never see partial files).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, ticker)
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 dates=prices.index.values.astype('datetime64[ns]'),
+                 values=prices.values.astype(np.float64),
+                 fields=np.array(prices.columns, dtype=str),
+                 start=np.datetime64(covered_start, 'ns'),
+                 end=np.datetime64(covered_end, 'ns'))
+    os.replace(tmp_path, path)
+
+def _empty_prices():
+    return pd.DataFrame(columns=PRICE_FIELDS, index=pd.DatetimeIndex([], name='Date'), dtype=np.float64)
+
+def _has_trading_days(range_start, range_end):
+    """
+    Whether [range_start, range_end) holds a weekday that is not a US federal holiday
+    """
+    from pandas.tseries.holiday import USFederalHolidayCalendar
+    trading_day = pd.offsets.CustomBusinessDay(calendar=USFederalHolidayCalendar())
+    return len(pd.date_range(range_start, range_end, freq=trading_day, inclusive='left')) > 0
+
+def _download_prices(tickers, start_date, end_date):
+    """
+    Download prices from Yahoo Finance and split them into one frame per ticker.
     """
+    # network modules are imported on use, cached and offline runs never load them
+    import yfinance as yf
     data = yf.download(tickers, start=start_date, end=end_date)
-    return data
+    if data is None or data.empty:
+        return {}
+
+    if not isinstance(data.columns, pd.MultiIndex):
+        data.columns = pd.MultiIndex.from_product([data.columns, tickers])
 
-def get_market_caps(tickers):
+    fields = [field for field in PRICE_FIELDS if field in data.columns.get_level_values(0)]
+    downloaded = {}
+    for ticker in tickers:
+        if ticker not in data.columns.get_level_values(1):
+            continue
+        prices = pd.concat({field: data[field][ticker] for field in fields}, axis=1).dropna(how='all')
+        prices.index = pd.DatetimeIndex(prices.index).tz_localize(None)
+        downloaded[ticker] = prices
+    return downloaded
+
+def get_stock_data(tickers, start_date, end_date, cache_dir=CACHE_DIR, offline=False):
     """
-    Fetch market capitalizations for given tickers using yfinance.Tickers().
+    Fetch adjusted close prices for the given tickers from Yahoo Finance.
+
+    Prices are served from a local per-ticker cache in cache_dir; only the tickers and date ranges
+    missing from the cache are downloaded. With offline=True the network is never touched and
+    tickers without cached data come back as NaN columns. Set cache_dir=None to bypass the cache.
     """
-    # Create a Tickers object for batch processing
-    ticker_data = yf.Tickers(tickers)
-    market_caps = []
+    if cache_dir is None:
+        import yfinance as yf
+        return yf.download(tickers, start=start_date, end=end_date)
+
+    if isinstance(tickers, str):
+        tickers = tickers.split()
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)  # exclusive, as in yf.download
+    # Do not mark days without a completed bar as covered
+    fetch_end = min(end, pd.Timestamp.today().normalize())
 
-    # Extract market caps
+    cached = {}
+    missing = {}  # (range_start, range_end) -> tickers
     for ticker in tickers:
-        try:
-            cap = ticker_data.tickers[ticker].info.get('marketCap', 0)
-            # data = ticker_data.history(period="1d")
-            if cap:  # Skip stocks with missing market cap
-                market_caps.append((ticker, cap))
-        except Exception as e:
-            print(f"Error fetching market cap for {ticker}: {e}")
+        entry = _load_cached_prices(cache_dir, ticker)
+        if entry is None:
+            ranges = [(start, fetch_end)]
+        else:
+            cached[ticker] = entry
+            _, covered_start, covered_end = entry
+            ranges = []
+            if start < covered_start:
+                ranges.append((start, covered_start))
+            if fetch_end > covered_end:
+                ranges.append((covered_end, fetch_end))
+        for rng in ranges:
+            if rng[0] < rng[1]:
+                missing.setdefault(rng, []).append(ticker)
+
+    if missing and offline:
+        print(f"Offline mode: {len(set(t for group in missing.values() for t in group))} tickers not fully cached")
+    elif missing:
+        for (range_start, range_end), group in missing.items():
+            downloaded = _download_prices(group, range_start, range_end)
+            # A ticker without prices is still covered over the range when the download returned prices of other tickers
+            # (e.g. a range before its listing) or the range has no trading day (weekend and holiday tails); otherwise
+            # the download failed (network error, rate limit) and the range is retried next time
+            covered = any(not fetched.empty for fetched in downloaded.values()) or not _has_trading_days(range_start, range_end)
+            for ticker in group:
+                fetched = downloaded.get(ticker)
+                if fetched is None or fetched.empty:
+                    if not covered:
+                        continue
+                    fetched = _empty_prices()
+                if ticker in cached:
+                    prices, covered_start, covered_end = cached[ticker]
+                    prices = pd.concat([prices, fetched])
+                    prices = prices[~prices.index.duplicated(keep='last')].sort_index()
+                    covered_start, covered_end = min(covered_start, range_start), max(covered_end, range_end)
+                else:
+                    prices, covered_start, covered_end = fetched, range_start, range_end
+                cached[ticker] = (prices, covered_start, covered_end)
+                _save_cached_prices(cache_dir, ticker, prices, covered_start, covered_end)
+
+    frames = {}
+    for ticker in sorted(tickers):
+        if ticker in cached:
+            prices = cached[ticker][0]
+            frames[ticker] = prices.loc[(prices.index >= start) & (prices.index < end)]
+        else:
+            frames[ticker] = _empty_prices()
+
+    data = pd.concat(frames, axis=1, names=['Ticker', 'Price']).swaplevel(axis=1)
+    data = data.reindex(columns=pd.MultiIndex.from_product([PRICE_FIELDS, sorted(tickers)], names=['Price', 'Ticker']))
+    data.index.name = 'Date'
+    return data
+
+class PricePanel:
+    """
+    Close prices (dates x tickers) of a universe loaded once
+
+    Hands out row/column slices for sub-universes and date ranges. Slices of a prefix of the universe
+    (e.g. sp500_tickers[:30] out of sp500_tickers) are zero-copy views of the panel.
+    """
+    def __init__(self, prices):
+        self.prices = prices
+
+    @classmethod
+    def load(cls, tickers, start_date, end_date, offline=False):
+        """
+        Load close prices of tickers (kept in the given order) from get_stock_data
+        """
+        return cls(get_stock_data(tickers, start_date, end_date, offline=offline)['Close'][list(tickers)])
+
+    def slice(self, tickers, start_date, end_date):
+        """
+        Close prices of tickers in [start_date, end_date), NaN columns for tickers not in the panel
+        """
+        index = self.prices.index
+        start = index.searchsorted(pd.Timestamp(start_date))
+        end = index.searchsorted(pd.Timestamp(end_date))
+        tickers = list(tickers)
+        if list(self.prices.columns[:len(tickers)]) == tickers:
+            return self.prices.iloc[start:end, :len(tickers)]
+        return self.prices.iloc[start:end].reindex(columns=pd.Index(tickers, name=self.prices.columns.name))
+
+    def get_stock_data(self, tickers, start_date, end_date, **kwargs):
+        """
+        Close prices of tickers in [start_date, end_date), in the format of get_stock_data
+        """
+        return pd.concat({'Close': self.slice(tickers, start_date, end_date)}, axis=1, names=['Price'])
+
+def _load_market_cap_snapshot(cache_dir):
+    path = os.path.join(cache_dir, MARKET_CAP_SNAPSHOT)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def _save_market_cap_snapshot(cache_dir, snapshot):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, MARKET_CAP_SNAPSHOT)
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+def _fetch_market_cap(ticker):
+    import yfinance as yf
+    try:
+        return ticker, yf.Ticker(ticker).info.get('marketCap', 0) or 0
+    except Exception as e:
+        print(f"Error fetching market cap for {ticker}: {e}")
+        return ticker, None
+
+def get_market_caps(tickers, max_workers=8, cache_dir=CACHE_DIR, ttl=MARKET_CAP_TTL, offline=False):
+    """
+    Fetch market capitalizations for given tickers using yfinance.
+
+    Caps are read from a local snapshot in cache_dir and only tickers missing from it or older than
+    ttl seconds are fetched, with at most max_workers concurrent requests. With offline=True the
+    network is never touched. Set cache_dir=None to bypass the snapshot.
+    """
+    snapshot = _load_market_cap_snapshot(cache_dir) if cache_dir is not None else {}
+    now = time.time()
+    stale = [] if offline else [ticker for ticker in tickers if ticker not in snapshot or now - snapshot[ticker][1] > ttl]
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for ticker, cap in executor.map(_fetch_market_cap, stale):
+                if cap is not None:  # Keep the previous snapshot on errors
+                    snapshot[ticker] = (cap, now)
+        if cache_dir is not None:
+            _save_market_cap_snapshot(cache_dir, snapshot)
+
+    # Skip stocks with missing market cap
+    market_caps = [(ticker, snapshot[ticker][0]) for ticker in tickers if ticker in snapshot and snapshot[ticker][0]]
 
     # Sort by market cap in descending order
     return sorted(market_caps, key=lambda x: x[1], reverse=True)
 
+def build_market_cap_history(prices, market_caps):
+    """
+    Stand-in market cap history (dates x tickers) from a snapshot of caps, scaling each cap by the price path:
+    cap_t = cap * price_t / price_last (constant shares outstanding).
+
+    :param:
+        prices: close prices (dates x tickers)
+        market_caps: list of (ticker, cap) as returned by get_market_caps
+    """
+    caps = pd.Series(dict(market_caps)).reindex(prices.columns)
+    return prices / prices.ffill().iloc[-1] * caps
+
+def save_market_cap_history(caps, path=MARKET_CAP_HISTORY):
+    """
+    Write a market cap history (dates x tickers) to a CSV file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    caps.to_csv(path)
+
+def load_market_cap_history(tickers, dates, path=MARKET_CAP_HISTORY):
+    """
+    File-backed market cap provider: (T, n) caps of tickers on dates, as needed by
+    RiskModel.shrinkage_covariance(cap=...). Caps are forward-filled to the requested dates.
+    """
+    caps = pd.read_csv(path, index_col=0, parse_dates=True)
+    caps = caps.reindex(columns=list(tickers))
+    caps = caps.reindex(caps.index.union(pd.DatetimeIndex(dates))).ffill().loc[pd.DatetimeIndex(dates)]
+    return caps.values
+
 def fetch_sp500_companies():
+    import requests
+    from bs4 import BeautifulSoup
+
     url = 'https://www.slickcharts.com/sp500'
     
     # Add headers to mimic a real browser
@@ -71,6 +317,189 @@ def fetch_sp500_companies():
 
     return companies
 
+def load_universe(path=UNIVERSE_FILE, refresh=False, offline=False):
+    """
+    S&P 500 tickers from the cached file at path, scraped with fetch_sp500_companies and saved there
+    if the file is missing or refresh=True. With offline=True a missing file raises FileNotFoundError.
+    """
+    if not refresh and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    if offline:
+        raise FileNotFoundError(f"No cached universe at {path}, run once online to create it")
+
+    tickers = fetch_sp500_companies()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(tickers, f)
+    os.replace(tmp_path, path)
+    return tickers
+
+def _yahoo_ticker(ticker):
+    return str(ticker).strip().replace('.', '-')
+
+def _membership_from_changes(current, changes):
+    """
+    Membership intervals from the current constituents and the dated index changes, replayed backwards
+
+    :param:
+        current: DataFrame with columns ticker and start (date added, NaT if unknown)
+        changes: DataFrame with columns date, added and removed (tickers or NaN)
+    :return:
+        list of (ticker, start, end), NaT start for members since before the first recorded change, NaT end for current members
+    """
+    open_end = {ticker: pd.NaT for ticker in current['ticker']}
+    intervals = []
+    for date, added, removed in changes.sort_values('date', ascending=False, kind='stable')[['date', 'added', 'removed']].itertuples(index=False):
+        if isinstance(added, str) and added in open_end:
+            intervals.append((added, date, open_end.pop(added)))
+        if isinstance(removed, str):
+            open_end[removed] = date
+    # Current members without a recorded addition joined on their date added, the others before the first change
+    date_added = dict(zip(current['ticker'], current['start']))
+    for ticker, end in open_end.items():
+        intervals.append((ticker, date_added.get(ticker, pd.NaT) if pd.isna(end) else pd.NaT, end))
+    return intervals
+
+class Membership:
+    """
+    Point-in-time index membership: one row (ticker, start, end) per membership interval, a ticker is a
+    member on the dates start <= date < end. A missing start means member since before the table's history,
+    a missing end means still a member.
+
+    The intervals are kept sorted by ticker as datetime64 arrays, so the members as of many dates
+    (e.g. every rebalance date of a back-test) are one broadcast comparison.
+    """
+    def __init__(self, table):
+        table = table[['ticker', 'start', 'end']].copy()
+        table['ticker'] = table['ticker'].map(_yahoo_ticker)
+        table['start'] = pd.to_datetime(table['start'])
+        table['end'] = pd.to_datetime(table['end'])
+        self.table = table.sort_values(['ticker', 'start'], na_position='first', kind='stable').reset_index(drop=True)
+        self._tickers, self._first = np.unique(self.table['ticker'].values.astype(str), return_index=True)
+        self._start = self.table['start'].values.astype('datetime64[ns]')
+        self._end = self.table['end'].values.astype('datetime64[ns]')
+        self._start[np.isnat(self._start)] = np.datetime64(pd.Timestamp.min.value, 'ns')
+        self._end[np.isnat(self._end)] = np.datetime64(pd.Timestamp.max.value, 'ns')
+
+    @property
+    def tickers(self):
+        """
+        Every ticker of the table, sorted
+        """
+        return self._tickers.tolist()
+
+    @classmethod
+    def load(cls, path=MEMBERSHIP_FILE):
+        return cls(pd.read_csv(path))
+
+    def save(self, path=MEMBERSHIP_FILE):
+        """
+        Write the table to a CSV file (atomically)
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        self.table.to_csv(tmp_path, index=False, date_format='%Y-%m-%d')
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """
+        Build the table from a saved snapshot file:
+            .html/.htm: the Wikipedia "List of S&P 500 companies" page, its constituents table (Symbol, Date added)
+                and its "Selected changes" table (Date, Added Ticker, Removed Ticker) replayed backwards
+            .csv with columns ticker, start, end: a membership table
+            .csv with columns date, tickers: dated constituent lists (comma-separated tickers), each list holding
+                until the next date
+        """
+        if path.lower().endswith(('.html', '.htm')):
+            tables = pd.read_html(path)
+            constituents = next(table for table in tables if 'Symbol' in table.columns)
+            changes = next(table for table in tables if isinstance(table.columns, pd.MultiIndex)
+                           and 'Added' in table.columns.get_level_values(0))
+            changes.columns = [' '.join(dict.fromkeys(column)).strip() for column in changes.columns]
+            date_column = next(column for column in changes.columns if 'Date' in column)
+            current = pd.DataFrame({
+                'ticker': constituents['Symbol'].map(_yahoo_ticker),
+                'start': pd.to_datetime(constituents.get('Date added'), errors='coerce'),
+            })
+            changes = pd.DataFrame({
+                'date': pd.to_datetime(changes[date_column], errors='coerce'),
+                'added': changes['Added Ticker'].map(lambda ticker: _yahoo_ticker(ticker) if isinstance(ticker, str) else None),
+                'removed': changes['Removed Ticker'].map(lambda ticker: _yahoo_ticker(ticker) if isinstance(ticker, str) else None),
+            }).dropna(subset=['date'])
+            return cls(pd.DataFrame(_membership_from_changes(current, changes), columns=['ticker', 'start', 'end']))
+
+        table = pd.read_csv(path)
+        table.columns = [column.strip().lower() for column in table.columns]
+        if {'ticker', 'start', 'end'} <= set(table.columns):
+            return cls(table)
+        if {'date', 'tickers'} <= set(table.columns):
+            table = table.assign(date=pd.to_datetime(table['date'])).sort_values('date')
+            dates = list(table['date'])
+            intervals = []
+            open_start = {}
+            for date, constituents in zip(dates, table['tickers']):
+                constituents = {_yahoo_ticker(ticker) for ticker in str(constituents).split(',') if ticker.strip()}
+                for ticker in set(open_start) - constituents:
+                    intervals.append((ticker, open_start.pop(ticker), date))
+                for ticker in constituents - set(open_start):
+                    open_start[ticker] = date
+            intervals.extend((ticker, start, pd.NaT) for ticker, start in open_start.items())
+            return cls(pd.DataFrame(intervals, columns=['ticker', 'start', 'end']))
+        raise ValueError(f"{path}: expected columns ticker, start, end or date, tickers")
+
+    def mask(self, dates, tickers):
+        """
+        Membership of tickers as of each date
+
+        :return:
+            boolean array (len(dates), len(tickers))
+        """
+        dates = pd.DatetimeIndex(dates).values.astype('datetime64[ns]')
+        # (dates, intervals) membership, reduced over the intervals of each ticker
+        active = (self._start[None, :] <= dates[:, None]) & (dates[:, None] < self._end[None, :])
+        tickers = np.asarray(list(tickers), dtype=str)
+        position = np.searchsorted(self._tickers, tickers)
+        known = position < len(self._tickers)
+        known[known] = self._tickers[position[known]] == tickers[known]
+
+        mask = np.zeros((len(dates), len(tickers)), dtype=bool)
+        if known.any():
+            mask[:, known] = np.logical_or.reduceat(active, self._first, axis=1)[:, position[known]]
+        return mask
+
+    def members(self, date, tickers=None):
+        """
+        Members as of date, in the order of tickers (default: every ticker of the table)
+        """
+        tickers = self.tickers if tickers is None else list(tickers)
+        return [ticker for ticker, member in zip(tickers, self.mask([date], tickers)[0]) if member]
+
+    def members_between(self, start_date, end_date, tickers=None):
+        """
+        Tickers that were members at some point of [start_date, end_date), in the order of tickers
+        (default: every ticker of the table)
+        """
+        start, end = np.datetime64(pd.Timestamp(start_date), 'ns'), np.datetime64(pd.Timestamp(end_date), 'ns')
+        overlapping = set(self.table['ticker'].values[(self._start < end) & (start < self._end)])
+        tickers = self.tickers if tickers is None else list(tickers)
+        return [ticker for ticker in tickers if ticker in overlapping]
+
+def load_membership(path=MEMBERSHIP_FILE, snapshot=None):
+    """
+    Point-in-time membership table cached at path, rebuilt from a saved snapshot (see Membership.from_snapshot)
+    and cached there when snapshot is given
+    """
+    if snapshot is not None:
+        membership = Membership.from_snapshot(snapshot)
+        membership.save(path)
+        return membership
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No membership table at {path}, build it from a saved snapshot with load_membership(snapshot=...)")
+    return Membership.load(path)
+
 if __name__ == "__main__":
     # !pip show yfinance
     # !pip install yfinance==0.2.50
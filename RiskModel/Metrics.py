@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+
+# Per-window and whole-run statistics of a rolling-window back-test, from the concatenated daily returns of all
+# test windows. Window w owns the daily returns [bounds[w], bounds[w + 1]), every per-window statistic is a
+# segment reduction over these bounds (np.add.reduceat) instead of one pandas Series per window.
+
+def _segment_sum(x, bounds):
+    """
+    Sums of x (N,) or (N, m) over the segments [bounds[w], bounds[w + 1]), 0 for empty segments
+    """
+    starts = bounds[:-1]
+    nonempty = starts < bounds[1:]
+    sums = np.zeros((len(starts),) + x.shape[1:])
+    if nonempty.any():
+        # Each non-empty segment runs up to the start of the next one, the empty ones in between hold nothing
+        sums[nonempty] = np.add.reduceat(x[:bounds[-1]], starts[nonempty], axis=0)
+    return sums
+
+def _segment_ids(bounds):
+    """
+    Window of each daily return
+    """
+    return np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+
+def segment_mean_std(x, bounds):
+    """
+    Means and standard deviations (ddof=1) of x (N,) over each segment, NaN where the segment is too short
+    """
+    counts = np.diff(bounds)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = _segment_sum(x, bounds) / counts
+        std = np.sqrt(_segment_sum((x - mean[_segment_ids(bounds)]) ** 2, bounds) / np.where(counts > 1, counts - 1, np.nan))
+    return mean, std
+
+def segment_correlation(x, y, bounds):
+    """
+    Correlations of x and y (N,) over each segment, centered per segment, NaN where undefined
+    """
+    counts = np.diff(bounds)
+    ids = _segment_ids(bounds)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = x - (_segment_sum(x, bounds) / counts)[ids]
+        dy = y - (_segment_sum(y, bounds) / counts)[ids]
+        return np.clip(_segment_sum(dx * dy, bounds) / np.sqrt(_segment_sum(dx * dx, bounds) * _segment_sum(dy * dy, bounds)), -1, 1)
+
+def segment_max_drawdown(returns, bounds):
+    """
+    Maximum drawdown of the value path of each segment's daily returns, from a start value of 1
+
+    :return:
+        array (W,) of drawdowns as positive fractions, 0 for empty segments
+    """
+    counts = np.diff(bounds)
+    steps = np.arange(counts.max(initial=0))
+    valid = steps < counts[:, None]
+    # (W, max length) daily returns, padded with zero returns that hold the value after each segment's end
+    padded = np.zeros(valid.shape)
+    padded[valid] = returns
+    log_value = np.concatenate([np.zeros((len(counts), 1)), np.cumsum(np.log1p(padded), axis=1)], axis=1)
+    return (1 - np.exp(log_value - np.maximum.accumulate(log_value, axis=1))).max(axis=1)
+
+def max_drawdown(returns):
+    """
+    Maximum drawdown of the value path of daily returns, from a start value of 1
+    """
+    log_value = np.concatenate([[0.0], np.cumsum(np.log1p(returns))])
+    return float(np.max(1 - np.exp(log_value - np.maximum.accumulate(log_value))))
+
+def turnover(allocs, growth=None):
+    """
+    Turnover of each rebalance: L1 distance between a window's allocations and those held at the end of the
+    previous window, which drifted with its price relatives (growth). The first window is bought from cash.
+
+    :param:
+        allocs: allocations (W, n)
+        growth: Optional, price relatives over each window (W, n), without them the allocations do not drift
+    :return:
+        array (W,)
+    """
+    allocs = np.asarray(allocs, dtype=np.float64)
+    held = np.zeros_like(allocs)
+    if growth is None:
+        held[1:] = allocs[:-1]
+    else:
+        drifted = allocs[:-1] * growth[:-1]
+        held[1:] = drifted / drifted.sum(axis=1, keepdims=True)
+    return np.abs(allocs - held).sum(axis=1)
+
+def window_metrics(portfolio_returns, benchmark_returns, bounds, rebalanced_returns=None):
+    """
+    Statistics of each test window
+
+    :param:
+        portfolio_returns: concatenated daily returns (N,) of each window's buy-and-hold portfolio
+        benchmark_returns: concatenated daily returns (N,) of the benchmark
+        bounds: window boundaries (W + 1,), window w owns the returns [bounds[w], bounds[w + 1])
+        rebalanced_returns: Optional, concatenated daily returns (N,) of the daily-rebalanced portfolio (asset returns
+            dot allocations), which the information ratio and coefficient are measured on (default: portfolio_returns)
+    :return:
+        dict of arrays (W,): Cumulative Return, Benchmark Cumulative Return, Average Daily Return, Realized Volatility
+        (daily, ddof=1), Information Ratio and Information Coefficient (NaN for windows too short), Max Drawdown
+    """
+    bounds = np.asarray(bounds)
+    portfolio_returns = np.asarray(portfolio_returns, dtype=np.float64)
+    benchmark_returns = np.asarray(benchmark_returns, dtype=np.float64)
+    if rebalanced_returns is None:
+        rebalanced_returns = portfolio_returns
+
+    cr = np.expm1(_segment_sum(np.log1p(portfolio_returns), bounds))
+    benchmark_cr = np.expm1(_segment_sum(np.log1p(benchmark_returns), bounds))
+    adr, realized_vol = segment_mean_std(portfolio_returns, bounds)
+
+    mean_active, std_active = segment_mean_std(rebalanced_returns - benchmark_returns, bounds)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ir = np.where(std_active > 0, mean_active * np.sqrt(252) / std_active, np.nan)
+    ic = segment_correlation(rebalanced_returns, benchmark_returns, bounds)
+
+    return {
+        "Cumulative Return": cr,
+        "Benchmark Cumulative Return": benchmark_cr,
+        "Average Daily Return": adr,
+        "Realized Volatility": realized_vol,
+        "Information Ratio": ir,
+        "Information Coefficient": ic,
+        "Max Drawdown": segment_max_drawdown(portfolio_returns, bounds),
+    }
+
+def run_metrics(window_returns, benchmark_window_returns, num_tickers, daily_returns=None, turnovers=None):
+    """
+    Whole-run statistics of monthly rebalanced test windows, as backtest_portfolio reports them
+
+    :param:
+        window_returns: cumulative return of each window (W,)
+        benchmark_window_returns: cumulative return of the benchmark over each window (W,)
+        num_tickers: universe size, the breadth of the information coefficient is 12 * num_tickers
+        daily_returns: Optional, concatenated daily returns (N,) of the run for its maximum drawdown
+        turnovers: Optional, turnover of each rebalance (W,)
+    :return:
+        dict of floats
+    """
+    window_returns = np.asarray(window_returns, dtype=np.float64)
+    num_windows = len(window_returns)
+    cum_return = np.prod(window_returns + 1) - 1
+    annualized_return = (cum_return + 1) ** (12 / num_windows) - 1
+    annualized_std_dev = np.std(window_returns, ddof=1) * np.sqrt(12)
+
+    active_returns = window_returns - np.asarray(benchmark_window_returns, dtype=np.float64)
+    cum_active_return = np.prod(active_returns + 1) - 1
+    annualized_active_return = (cum_active_return + 1) ** (12 / num_windows) - 1
+    annualized_active_std_dev = np.std(active_returns, ddof=1) * np.sqrt(12)
+    ir = annualized_active_return / annualized_active_std_dev
+
+    metrics = {
+        "Cumulative Return": cum_return,
+        "Annualized Return": annualized_return,
+        "Standard Deviation": annualized_std_dev,
+        "Sharpe Ratio": annualized_return / annualized_std_dev,
+        "Information Ratio": ir,
+        "Information Coefficient": ir / np.sqrt(12 * num_tickers),
+    }
+    if daily_returns is not None:
+        metrics["Max Drawdown"] = max_drawdown(daily_returns)
+    if turnovers is not None:
+        metrics["Average Turnover"] = float(np.mean(turnovers))
+    return {name: float(value) for name, value in metrics.items()}
+
+def format_allocations(allocs, tickers, decimals=4):
+    """
+    "ticker: weight" strings of each row of allocs (W, n), by decreasing rounded weight, without zero weights
+    """
+    allocs = np.asarray(allocs, dtype=np.float64)
+    rounded = np.round(allocs, decimals)
+    order = np.argsort(-rounded, axis=1, kind='stable')
+    return [", ".join(f"{tickers[i]}: {row[i]:.{decimals}f}" for i in index if rounded_row[i] != 0)
+            for row, rounded_row, index in zip(allocs, rounded, order)]
+
+def allocations_frame(allocs, tickers, index=None):
+    """
+    Allocations (W, n) as a DataFrame with one column per ticker
+    """
+    return pd.DataFrame(np.asarray(allocs, dtype=np.float64), index=index, columns=list(tickers))
@@ -1,11 +1,12 @@
 import datetime as dt
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import scipy.optimize as spo
-from RiskModel import RiskModel
-from DataLoader import get_stock_data, get_market_caps, fetch_sp500_companies
-from sklearn.covariance import LedoitWolf
+from RiskModel import RiskModel, RollingCovariance, FactorCovariance, batch_covariance, estimator_name
+from DataLoader import get_stock_data, get_market_caps, load_universe
+from Profiler import NULL_PROFILER
+from Metrics import window_metrics, run_metrics, turnover, format_allocations, allocations_frame
 import time
 import random
 
@@ -17,7 +18,7 @@ def assess_portfolio(prices, allocs, cov_matrix=None):
     ----------
     prices: DataFrame of stock prices
     allocs: List of asset allocations
-    cov_matrix: Covariance matrix (sample or Ledoit-Wolf shrinkage)
+    cov_matrix: Covariance matrix (sample or Ledoit-Wolf shrinkage, dense or RiskModel.FactorCovariance)
 
     Returns
     -------
@@ -38,7 +39,43 @@ def assess_portfolio(prices, allocs, cov_matrix=None):
     if cov_matrix is None:
         cov_matrix = np.cov(daily_rets, rowvar=False)
 
-    port_volatility = np.sqrt(np.dot(allocs.T, np.dot(cov_matrix, allocs)))
+    if isinstance(cov_matrix, FactorCovariance):
+        port_volatility = np.sqrt(cov_matrix.quad(allocs))
+    else:
+        port_volatility = np.sqrt(np.dot(allocs.T, np.dot(cov_matrix, allocs)))
+    sr = np.sqrt(252) * adr / port_volatility
+
+    return cr, adr, port_volatility, sr
+
+def assess_portfolios(prices, allocs, cov_matrix=None):
+    """
+    Assess K candidate allocations at once, as assess_portfolio for each row of allocs.
+
+    Parameters
+    ----------
+    prices: DataFrame or array of stock prices (T,n)
+    allocs: Candidate allocations (K,n)
+    cov_matrix: Covariance matrix (dense or RiskModel.FactorCovariance), without it the volatility
+        is the sample standard deviation of each portfolio's daily returns
+
+    Returns
+    -------
+    cr, adr, sddr, sr: arrays (K,) of cumulative returns, average daily returns, volatilities and Sharpe ratios
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    allocs = np.atleast_2d(np.asarray(allocs, dtype=np.float64))
+    port_val = np.matmul(prices / prices[0], allocs.T)  # (T,K)
+    daily_rets = port_val[1:] / port_val[:-1] - 1
+
+    cr = port_val[-1] / port_val[0] - 1
+    adr = daily_rets.mean(axis=0)
+
+    if cov_matrix is None:
+        port_volatility = daily_rets.std(axis=0, ddof=1)
+    elif isinstance(cov_matrix, FactorCovariance):
+        port_volatility = np.sqrt(cov_matrix.quad(allocs))
+    else:
+        port_volatility = np.sqrt(np.einsum('ki,ki->k', np.matmul(allocs, cov_matrix), allocs))
     sr = np.sqrt(252) * adr / port_volatility
 
     return cr, adr, port_volatility, sr
@@ -50,55 +87,423 @@ def error_fct(allocs, prices, cov_matrix):
     _, _, _, sr = assess_portfolio(prices, allocs, cov_matrix)
     return -sr  # Inverse for minimization
 
-def fit_alloc(prices, cov_matrix, error_fct):
+class SharpeObjective:
+    """
+    Negative Sharpe ratio of assess_portfolio and its exact gradient, computed on cached NumPy arrays.
+
+    Normalized prices and the covariance matrix are prepared once, so each evaluation costs one (T,n)
+    matrix-vector product and one (n,n) product (O(n k) for a FactorCovariance) instead of rebuilding pandas frames.
+    """
+    def __init__(self, prices, cov_matrix):
+        prices = np.asarray(prices, dtype=np.float64)
+        self.normed = prices / prices[0]
+        if isinstance(cov_matrix, FactorCovariance):
+            self.cov_matrix = cov_matrix.astype(np.float64)
+        else:
+            self.cov_matrix = np.atleast_2d(np.asarray(cov_matrix, dtype=np.float64))
+        self.nfev = 0
+
+    def mean_return(self, allocs):
+        """
+        :return:
+            adr: average daily return of the portfolio
+            grad_adr: its gradient with respect to allocs
+        """
+        normed = self.normed
+        port_val = np.matmul(normed, allocs)
+        prev_val = port_val[:-1]
+        daily_rets = port_val[1:] / prev_val - 1
+
+        # d r_t / d a = N_t / v_{t-1} - v_t N_{t-1} / v_{t-1}^2
+        num_days = len(daily_rets)
+        grad_adr = (np.matmul(1 / prev_val, normed[1:]) - np.matmul(port_val[1:] / prev_val ** 2, normed[:-1])) / num_days
+        return daily_rets.mean(), grad_adr
+
+    def __call__(self, allocs):
+        """
+        :return:
+            -sr: negative Sharpe ratio (as error_fct)
+            -grad: its gradient with respect to allocs
+        """
+        self.nfev += 1
+        adr, grad_adr = self.mean_return(allocs)
+
+        cov_allocs = self.cov_matrix.dot(allocs)
+        port_volatility = np.sqrt(np.dot(allocs, cov_allocs))
+        sr = np.sqrt(252) * adr / port_volatility
+        grad_sr = np.sqrt(252) * (grad_adr / port_volatility - adr * cov_allocs / port_volatility ** 3)
+
+        return -sr, -grad_sr
+
+def max_sharpe_qp(mu, cov_matrix, tol=1e-12, max_iter=None):
+    """
+    Long-only, fully invested allocation maximizing mu'a / sqrt(a' cov_matrix a).
+
+    Solves the convex QP  min y' cov_matrix y  s.t.  mu'y = 1, y >= 0  with a primal active-set method
+    and returns a = y / sum(y). Returns None if no asset has a positive expected return or the
+    covariance restricted to the active assets is singular.
+    A FactorCovariance is solved on the free assets by the Woodbury identity in O(n k^2) instead of O(n^3).
+    """
+    mu = np.asarray(mu, dtype=np.float64)
+    if not isinstance(cov_matrix, FactorCovariance):
+        cov_matrix = np.atleast_2d(np.asarray(cov_matrix, dtype=np.float64))
+    n = len(mu)
+    if mu.max() <= 0:
+        return None
+
+    # Feasible start: the single asset with the highest expected return
+    k = np.argmax(mu)
+    y = np.zeros(n)
+    y[k] = 1 / mu[k]
+    free = np.zeros(n, dtype=bool)
+    free[k] = True
+
+    for _ in range(max_iter or 10 * n):
+        idx = np.flatnonzero(free)
+        try:
+            if isinstance(cov_matrix, FactorCovariance):
+                x = cov_matrix.submatrix(idx).solve(mu[idx])
+            else:
+                x = np.linalg.solve(cov_matrix[np.ix_(idx, idx)], mu[idx])
+        except np.linalg.LinAlgError:
+            return None
+        denom = np.dot(mu[idx], x)
+        if denom <= 0:
+            return None
+        target = x / denom  # minimizer on the free assets, with mu'y = 1
+
+        if target.min() >= 0:
+            y = np.zeros(n)
+            y[idx] = target
+            # Multipliers of the bounds y_i >= 0 for the assets held at zero
+            nu = 2 * cov_matrix.dot(y) - 2 / denom * mu
+            nu[idx] = 0
+            j = np.argmin(nu)
+            if nu[j] >= -tol * np.abs(nu).max():
+                return y / y.sum()
+            free[j] = True
+        else:
+            # Move towards the target until the first free asset hits zero, then fix it at zero
+            step = target - y[idx]
+            blocking = step < 0
+            ratios = y[idx][blocking] / -step[blocking]
+            i = np.argmin(ratios)
+            y[idx] += min(1.0, ratios[i]) * step
+            drop = idx[blocking][i]
+            y[drop] = 0
+            free[drop] = False
+
+    return None
+
+def _long_only_frontier(mu, cov_matrix, target_returns, max_iter=None):
+    """
+    Long-only, fully invested minimum-variance portfolios of efficient_frontier (NaN for the unreachable targets)
+
+    Starts from the long-only minimum-variance portfolio (max_sharpe_qp of unit returns) and follows the critical
+    line through the targets above its return in increasing order and through those below in decreasing order.
+    Between two changes of the set of held assets the allocations and the bound multipliers are affine in the target
+    return, so each target warm-starts from the previous one and only a change of the set refactors its covariance.
+    """
+    n = len(mu)
+    allocs = np.full((len(target_returns), n), np.nan)
+    y = max_sharpe_qp(np.ones(n), cov_matrix)
+    if y is None:
+        return allocs
+    if not isinstance(cov_matrix, FactorCovariance):
+        from scipy.linalg import cho_factor, cho_solve
+        cov_matrix = np.atleast_2d(np.asarray(cov_matrix, dtype=np.float64))
+    constraints = np.vstack([np.ones(n), mu])
+    min_return = np.dot(mu, y)
+    # Targets within tol of an event are reached before it, e.g. the largest expected return by its single asset
+    tol = 1e-12 * (mu.max() - mu.min())
+
+    for sign in (1, -1):
+        order = np.argsort(sign * target_returns)
+        order = order[sign * (target_returns[order] - min_return) >= 0]
+        w, r, free = y.copy(), min_return, y > 0
+        iterations = 0
+        for k in order:
+            target = target_returns[k]
+            if not mu.min() <= target <= mu.max():
+                continue
+            while iterations < (max_iter or 10 * n):
+                iterations += 1
+                idx = np.flatnonzero(free)
+                if len(idx) == 1:
+                    # Single asset: enter the asset whose mix with it raises the variance the least per unit of return
+                    j = idx[0]
+                    if abs(target - mu[j]) <= tol:
+                        allocs[k] = np.eye(n)[j]
+                        break
+                    gap = sign * (mu - mu[j])
+                    if gap.max() <= 0:
+                        break
+                    column = cov_matrix.dot(np.eye(n)[j])
+                    rate = np.full(n, np.inf)
+                    rate[gap > 0] = (column - column[j])[gap > 0] / gap[gap > 0]
+                    free[np.argmin(rate)] = True
+                    continue
+                # w_F = M lam with G lam = (1, r): the minimum-variance allocations of the held assets at return r
+                if isinstance(cov_matrix, FactorCovariance):
+                    M = cov_matrix.submatrix(idx).solve(constraints[:, idx].T)
+                else:
+                    M = cho_solve(cho_factor(cov_matrix[np.ix_(idx, idx)]), constraints[:, idx].T)
+                G = constraints[:, idx].dot(M)
+                try:
+                    lam, dlam = np.linalg.solve(G, np.array([[1, 0], [r, sign]], dtype=np.float64)).T
+                except np.linalg.LinAlgError:
+                    break
+                w = np.zeros(n)
+                w[idx] = M.dot(lam)
+                dw = np.zeros(n)
+                dw[idx] = M.dot(dlam)
+                # Multipliers of the bounds w_i >= 0 of the assets held at zero, and their change per unit of return
+                nu = cov_matrix.dot(w) - constraints.T.dot(lam)
+                dnu = cov_matrix.dot(dw) - constraints.T.dot(dlam)
+                steps = np.full(n, np.inf)
+                dropping = free & (dw < 0)
+                steps[dropping] = w[dropping] / -dw[dropping]
+                entering = ~free & (dnu < 0)
+                steps[entering] = np.maximum(nu[entering], 0) / -dnu[entering]
+                i = np.argmin(steps)
+                if steps[i] >= sign * (target - r) - tol:
+                    w = np.maximum(w + sign * (target - r) * dw, 0)
+                    r = target
+                    allocs[k] = w / w.sum()
+                    break
+                r += sign * steps[i]
+                free[i] = not free[i]
+    return allocs
+
+def efficient_frontier(mu, cov_matrix, target_returns=None, num_points=50, long_only=False):
+    """
+    Minimum-variance, fully invested portfolios for a range of target returns.
+
+    With short sales allowed the frontier is spanned by two portfolios, cov^-1 1 and cov^-1 mu, so one
+    factorization of the covariance (Cholesky, or the Woodbury identity for a FactorCovariance) serves every
+    target return. With long_only=True the allocations are bounded to (0, 1) as in every other optimizer of this
+    module: the frontier starts at the long-only minimum-variance portfolio (max_sharpe_qp of unit returns) and
+    follows the active set from target to target (see _long_only_frontier), instead of one SLSQP run per target.
+
+    :param:
+        mu: expected (daily) returns (n,)
+        cov_matrix: covariance matrix (n,n) or RiskModel.FactorCovariance
+        target_returns: Optional, target returns (K,), default num_points from the minimum-variance
+            portfolio's return to the largest expected return
+        long_only: no short sales; targets outside [mu.min(), mu.max()] get NaN allocations and volatilities
+    :return:
+        target_returns (K,), allocations (K,n), volatilities (K,)
+    """
+    mu = np.asarray(mu, dtype=np.float64)
+    if long_only:
+        if target_returns is None:
+            min_variance = max_sharpe_qp(np.ones_like(mu), cov_matrix)
+            min_return = mu.max() if min_variance is None else np.dot(mu, min_variance)
+            target_returns = np.linspace(min_return, mu.max(), num_points)
+        target_returns = np.asarray(target_returns, dtype=np.float64)
+        allocs = _long_only_frontier(mu, cov_matrix, target_returns)
+        if isinstance(cov_matrix, FactorCovariance):
+            volatilities = np.sqrt(cov_matrix.quad(allocs))
+        else:
+            volatilities = np.sqrt(np.einsum('ij,jk,ik->i', allocs, np.asarray(cov_matrix, dtype=np.float64), allocs))
+        return target_returns, allocs, volatilities
+
+    ones = np.ones_like(mu)
+    rhs = np.column_stack([ones, mu])
+    if isinstance(cov_matrix, FactorCovariance):
+        inv_ones, inv_mu = cov_matrix.astype(np.float64).solve(rhs).T
+    else:
+        from scipy.linalg import cho_factor, cho_solve
+        inv_ones, inv_mu = cho_solve(cho_factor(np.asarray(cov_matrix, dtype=np.float64)), rhs).T
+
+    a, b, c = np.dot(ones, inv_ones), np.dot(ones, inv_mu), np.dot(mu, inv_mu)
+    d = a * c - b ** 2
+    if target_returns is None:
+        target_returns = np.linspace(b / a, mu.max(), num_points)
+    target_returns = np.asarray(target_returns, dtype=np.float64)
+
+    # w(r) = ((c - r b) cov^-1 1 + (r a - b) cov^-1 mu) / d
+    allocs = (np.outer(c - target_returns * b, inv_ones) + np.outer(target_returns * a - b, inv_mu)) / d
+    volatilities = np.sqrt((a * target_returns ** 2 - 2 * b * target_returns + c) / d)
+    return target_returns, allocs, volatilities
+
+def _fit_alloc_qp(objective, ini_guess, tol=1e-9, max_iter=100, ftol=1e-12):
+    """
+    Maximize the Sharpe ratio of SharpeObjective with a sequence of QPs.
+
+    The average daily return of the buy-and-hold portfolio is not linear in the allocations, so at each
+    step it is linearized on the simplex around the current allocations (mu = grad_adr + adr) and the
+    max-Sharpe QP is solved for that mu. A fixed point satisfies the KKT conditions of the original problem.
+    Both Sharpe ratios agree to first order at the current allocations, so the QP solution is an ascent
+    direction; the full step to it overshoots and zig-zags, so the step length along it comes from a quadratic
+    interpolation of the exact Sharpe ratio, safeguarded by backtracking (Armijo).
+
+    :return:
+        allocs (None if the iteration does not converge), number of QPs solved
+    """
+    allocs = ini_guess
+    neg_sr, neg_grad = objective(allocs)
+    for nit in range(1, max_iter + 1):
+        adr, grad_adr = objective.mean_return(allocs)
+        new_allocs = max_sharpe_qp(grad_adr + adr, objective.cov_matrix)
+        if new_allocs is None:
+            return None, nit
+        step = new_allocs - allocs
+        if np.abs(step).max() < tol:
+            return new_allocs, nit
+        slope = np.dot(neg_grad, step)
+        if slope >= 0:
+            return None, nit
+
+        # Minimizer of the quadratic through the negative Sharpe ratio and its slope at 0 and its value at 1
+        t = 1.0
+        trial_neg_sr, trial_neg_grad = objective(new_allocs)
+        curvature = trial_neg_sr - neg_sr - slope
+        if curvature > 0 and -slope < 2 * curvature:
+            t_min = -slope / (2 * curvature)
+            min_neg_sr, min_neg_grad = objective(allocs + t_min * step)
+            if min_neg_sr < trial_neg_sr:
+                t, trial_neg_sr, trial_neg_grad = t_min, min_neg_sr, min_neg_grad
+        while trial_neg_sr > neg_sr + 1e-4 * t * slope:
+            t /= 2
+            if t < 1e-10:
+                return None, nit
+            trial_neg_sr, trial_neg_grad = objective(allocs + t * step)
+
+        allocs = allocs + t * step
+        improvement = neg_sr - trial_neg_sr
+        neg_sr, neg_grad = trial_neg_sr, trial_neg_grad
+        if improvement <= ftol * abs(neg_sr):
+            return allocs, nit
+    return None, max_iter
+
+def fit_alloc(prices, cov_matrix, error_fct=None, solver='SLSQP', ini_guess=None, return_info=False):
     """
     Fit a portfolio allocation that minimizes the error function.
+
+    Without an error function the negative Sharpe ratio is minimized through SharpeObjective,
+    which gives SLSQP the exact gradient instead of finite differences.
+    solver='QP' maximizes the same Sharpe ratio with the active-set QP solver (max_sharpe_qp),
+    falling back to SLSQP if it fails, which is printed and flagged as 'fallback' in the solve info.
+    ini_guess: Optional, starting allocations (default: equal weights)
+    return_info: also return a dict with the solver, its iterations, function evaluations, solve time and whether
+        the QP solver fell back to SLSQP
     """
+    start_time = time.perf_counter()
     num_assets = len(prices.columns)
-    ini_guess = np.array([1.0 / num_assets] * num_assets)
+    if ini_guess is None:
+        ini_guess = np.array([1.0 / num_assets] * num_assets)
+
+    fallback = False
+    if solver == 'QP' and error_fct is None:
+        objective = SharpeObjective(prices.values, cov_matrix)
+        allocs, nit = _fit_alloc_qp(objective, ini_guess)
+        if allocs is not None:
+            info = {'solver': 'QP', 'nit': nit, 'nfev': objective.nfev, 'time': time.perf_counter() - start_time, 'fallback': False}
+            return (allocs, info) if return_info else allocs
+        print(f"QP solver did not converge after {nit} QPs, falling back to SLSQP")
+        fallback = True
 
     # Call optimizer to minimize error function
+    import scipy.optimize as spo
     bnds = tuple((0, 1) for _ in range(num_assets))
     cons = ({'type': 'eq', 'fun': lambda a: 1 - np.sum(a)})
-    result = spo.minimize(error_fct, 
-                          ini_guess, 
-                          args=(prices, cov_matrix), 
-                          method='SLSQP',
-                          bounds=bnds, 
-                        #   options={'disp': True},
-                          constraints=cons)
-    return result.x
+    if error_fct is None:
+        result = spo.minimize(SharpeObjective(prices.values, cov_matrix),
+                              ini_guess,
+                              method='SLSQP',
+                              jac=True,
+                              bounds=bnds,
+                              constraints=cons)
+    else:
+        result = spo.minimize(error_fct, 
+                              ini_guess, 
+                              args=(prices, cov_matrix), 
+                              method='SLSQP',
+                              bounds=bnds, 
+                            #   options={'disp': True},
+                              constraints=cons)
 
-def optimize_portfolio(sd='2021-01-01', ed='2025-01-01', syms=["AAPL", "MSFT", "GOOGL", "AMZN"], risk_matrix='Sample', shrink_target_method=None, gen_plot=False):
+    info = {'solver': 'SLSQP', 'nit': result.nit, 'nfev': result.nfev, 'time': time.perf_counter() - start_time, 'fallback': fallback}
+    return (result.x, info) if return_info else result.x
+
+def _drop_missing(prices):
+    """
+    prices.dropna(axis=1), without copying when no column has missing values
+    """
+    missing = prices.isna().any().values
+    return prices.loc[:, ~missing] if missing.any() else prices
+
+def optimize_portfolio(sd='2021-01-01', ed='2025-01-01', syms=["AAPL", "MSFT", "GOOGL", "AMZN"], risk_matrix='Sample', shrink_target_method=None, gen_plot=False, offline=False, solver='SLSQP', loader=get_stock_data, panel=None, profiler=None, dtype=np.float64, num_factors=1, covariance_cache=None, return_tickers=False):
     """
     Optimize the portfolio allocation to maximize the Sharpe ratio.
+
+    solver: 'SLSQP' or 'QP' (see fit_alloc)
+    loader: function with the signature of DataLoader.get_stock_data providing the prices
+    panel: Optional, preloaded DataLoader.PricePanel to slice the prices from instead of calling loader
+    profiler: Optional, Profiler.Profiler receiving the stage timings and counters of the run
+    dtype: floating point precision of the covariance estimation, np.float64 or np.float32 (the optimization runs in float64)
+    num_factors: number of statistical factors of risk_matrix='Factor' (RiskModel.factor_covariance)
+    covariance_cache: Optional, RiskModel.CovarianceCache; the Sample and Ledoit-Wolf estimators of the same tickers and
+        dates are computed together once (RiskModel.covariance_estimators) when the cache keeps them, and served from it to
+        every risk model
+    return_tickers: also return the tickers of the allocations, the syms with prices over the whole period (the others are
+        dropped before the optimization)
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    record = profiler.record(function='optimize_portfolio', risk_matrix=risk_matrix, shrink_target_method=shrink_target_method,
+                             solver=solver, num_tickers=len(syms), start=sd, end=ed)
 
     # Fetch stock prices
-    stock_data = get_stock_data(syms, sd, ed)
-    stock_data = stock_data.dropna(axis=1)
-    prices = stock_data['Close']
+    if panel is not None:
+        prices = _drop_missing(panel.slice(syms, sd, ed))
+    else:
+        stock_data = loader(syms, sd, ed, offline=offline)
+        stock_data = stock_data.dropna(axis=1)
+        prices = stock_data['Close']
     
-    returns = prices.pct_change().dropna().values
+    returns = prices.pct_change().dropna().values.astype(dtype, copy=False)
+    profiler.lap(record, 'load')
+
+    # Every estimator is only computed on a miss the cache will keep, otherwise just the risk model's own
+    covariances = None
+    if covariance_cache is not None and risk_matrix != 'Factor':
+        key = (tuple(prices.columns), prices.index[0], prices.index[-1], np.dtype(dtype).str)
+        covariances = covariance_cache.get(key)
+        if covariances is None and covariance_cache.accepts(prices.shape[1], dtype):
+            covariances, _ = RiskModel(dtype).covariance_estimators(returns)
+            covariance_cache.put(key, covariances)
 
     # Apply the Ledoit-Wolf shrinkage model
-    if risk_matrix == 'Sample':
-        cov_matrix = np.cov(returns, rowvar=False)
+    if covariances is not None:
+        cov_matrix = covariances[estimator_name(risk_matrix, shrink_target_method)]
+    elif risk_matrix == 'Sample':
+        cov_matrix = np.cov(returns, rowvar=False, dtype=dtype)
     
     elif risk_matrix == 'LedoitWolf':
-        rm = RiskModel()
+        rm = RiskModel(dtype)
         cov_matrix, _, _, _ = rm.shrinkage_covariance(returns=returns, shrink_target_method=shrink_target_method)
     elif risk_matrix == 'LedoitWolfSkLearn':
+        # sklearn, scipy.optimize and matplotlib are imported on use, they dominate the start-up time
+        from sklearn.covariance import LedoitWolf
         lw = LedoitWolf()
         cov_matrix = lw.fit(returns).covariance_
-    
+    elif risk_matrix == 'Factor':
+        cov_matrix = RiskModel(dtype).factor_covariance(returns, num_factors)
+    profiler.lap(record, 'covariance')
     
     # Find optimal allocations
-    allocs = fit_alloc(prices, cov_matrix, error_fct)
+    allocs, solve_info = fit_alloc(prices, cov_matrix, solver=solver, return_info=True)
+    profiler.lap(record, 'optimize')
 
     cr, adr, sddr, sr = assess_portfolio(prices, allocs, cov_matrix)
+    profiler.lap(record, 'evaluate')
+    profiler.commit(record, solver_used=solve_info['solver'], nit=solve_info['nit'], nfev=solve_info['nfev'],
+                    num_assets=prices.shape[1], num_days=returns.shape[0])
 
     if gen_plot:
+        import matplotlib.pyplot as plt
         normed = prices / prices.iloc[0]
         alloced = normed * allocs
         port_val = alloced.sum(axis=1)
@@ -108,6 +513,8 @@ def optimize_portfolio(sd='2021-01-01', ed='2025-01-01', syms=["AAPL", "MSFT", "
         # plt.savefig('images/plot.png')
         plt.show()
 
+    if return_tickers:
+        return allocs, cr, adr, sddr, sr, list(prices.columns)
     return allocs, cr, adr, sddr, sr
 
 def compute_information_ratio(portfolio_return, benchmark_return, portfolio_std):
@@ -115,106 +522,389 @@ def compute_information_ratio(portfolio_return, benchmark_return, portfolio_std)
     tracking_error = portfolio_std  # Assuming tracking error ≈ portfolio std deviation
     return active_return / tracking_error if tracking_error > 0 else np.nan
 
+def _window_covariance(train_returns, risk_matrix, shrink_target_method, dtype=np.float64, num_factors=1):
+    """
+    Covariance matrix of one training window of backtest_portfolio, estimated from its daily returns alone
+    """
+    if risk_matrix == 'Sample':
+        return np.cov(train_returns, rowvar=False, dtype=dtype)
+    if risk_matrix == 'LedoitWolf':
+        cov_matrix, _, _, _ = RiskModel(dtype).shrinkage_covariance(returns=train_returns, shrink_target_method=shrink_target_method)
+        return cov_matrix
+    if risk_matrix == 'LedoitWolfSkLearn':
+        from sklearn.covariance import LedoitWolf
+        return LedoitWolf().fit(train_returns.astype(dtype, copy=False)).covariance_
+    if risk_matrix == 'Factor':
+        return RiskModel(dtype).factor_covariance(train_returns, num_factors)
+
+def _model_volatility(allocs, cov_matrix):
+    """
+    Daily volatility of the allocations under the covariance matrix (dense or FactorCovariance)
+    """
+    if isinstance(cov_matrix, FactorCovariance):
+        return np.sqrt(cov_matrix.quad(allocs))
+    return np.sqrt(np.dot(allocs, np.dot(cov_matrix, allocs)))
+
+# Data of the back-test run by a window pool worker process (see _init_window_worker)
+_WINDOW_CONTEXT = {}
+
+def _solve_window(context, train_start_date, train_end_date, columns, cov_matrix):
+    """
+    Solve the allocations of one window of backtest_portfolio under its estimated covariance matrix from equal weights,
+    as the serial loop does without warm start
+
+    :param:
+        context: dict with the run's prices and solver
+    :return:
+        allocs, model volatility, solve info of fit_alloc, stage timings ('optimize_time')
+    """
+    start_time = time.perf_counter()
+    train_prices = context['prices'].loc[train_start_date:train_end_date].iloc[:, columns]
+    allocs, solve_info = fit_alloc(train_prices, cov_matrix, solver=context['solver'], return_info=True)
+    return allocs, _model_volatility(allocs, cov_matrix), solve_info, {'optimize_time': time.perf_counter() - start_time}
+
+def _init_window_worker(context, blas_threads):
+    """
+    Window pool process initializer: keep the back-test's data and pin the BLAS threads of the worker
+    """
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(blas_threads)
+    _WINDOW_CONTEXT.update(context)
+
+def _solve_window_task(task):
+    return _solve_window(_WINDOW_CONTEXT, *task)
+
+def _solve_windows(context, tasks, window_workers, window_executor='process'):
+    """
+    Solve the windows of backtest_portfolio over a pool of window_workers processes or threads, each using an equal
+    share of the cores for BLAS, so that the pool does not run more BLAS threads than there are cores
+
+    :param:
+        context: see _solve_window
+        tasks: iterable of the arguments (train_start_date, train_end_date, columns, cov_matrix) of each window, consumed
+            as the windows are submitted, so that producing the next one overlaps the solves of the previous ones
+        window_executor: 'process' (ProcessPoolExecutor) or 'thread' (ThreadPoolExecutor, sharing the data without
+            copying it but only running NumPy and BLAS calls concurrently)
+    :return:
+        list of _solve_window results in the order of tasks
+    """
+    from threadpoolctl import threadpool_limits
+    blas_threads = max(1, (os.cpu_count() or 1) // window_workers)
+    if window_executor == 'thread':
+        # The BLAS thread limit is process-wide, it holds for every thread of the pool while it runs
+        with threadpool_limits(blas_threads), ThreadPoolExecutor(max_workers=window_workers) as executor:
+            return list(executor.map(lambda task: _solve_window(context, *task), tasks))
+    with ProcessPoolExecutor(max_workers=window_workers, initializer=_init_window_worker,
+                             initargs=(context, blas_threads)) as executor:
+        # map returns the results in the order of the windows, whichever worker finishes first
+        return list(executor.map(_solve_window_task, tasks))
+
 def backtest_portfolio(sd='2014-12-31', ed='2024-12-31', tickers=["AAPL", "MSFT", "GOOGL", "AMZN"], 
                         risk_matrix='Sample', shrink_target_method=None, window_size_month = 12, step_size_month = 1,
-                        benchmark_ticker="SPY"):
+                        benchmark_ticker="SPY", offline=False, incremental_cov=True, solver='SLSQP',
+                        loader=get_stock_data, panel=None, warm_start=True, profiler=None,
+                        returns_store=None, batch_cov=False, dtype=np.float64, num_factors=1, return_results=False,
+                        reopt_threshold=None, reopt_metric='frobenius', membership=None, covariance_cache=None,
+                        window_workers=None, window_executor='process'):
     """
     Backtest portfolio optimization using a rolling window approach.
+
+    With incremental_cov=True the covariance matrix is maintained by a RollingCovariance that only adds
+    the month entering and removes the month leaving the training window at each step.
+    solver: 'SLSQP' or 'QP' (see fit_alloc)
+    loader: function with the signature of DataLoader.get_stock_data providing the prices
+    panel: Optional, preloaded DataLoader.PricePanel (with the benchmark) to slice the prices from instead of calling loader
+    warm_start: start each window's optimization from the previous window's allocations
+    profiler: Optional, Profiler.Profiler receiving per-window stage timings and counters instead of the progress prints
+    returns_store: Optional, ReturnsStore.ReturnsStore of the same prices, training returns are read from it as views
+    batch_cov: estimate every window's covariance matrix up front in one batched pass (RiskModel.batch_covariance)
+        instead of one window at a time
+    dtype: floating point precision of the covariance estimation, np.float64 or np.float32 (the optimization runs in float64).
+        The incremental RollingCovariance accumulates in float64, so with another dtype incremental_cov is ignored and each
+        window is estimated from its own returns in that dtype. A returns_store built with the same dtype
+        (ReturnsStore.build(prices, path, dtype)) halves the bytes read per window
+    num_factors: number of statistical factors of risk_matrix='Factor' (RiskModel.factor_covariance), estimated from each
+        window's returns and passed to the optimizer as a FactorCovariance
+    return_results: also return the per-window results DataFrame (the rows of the CSV written to result/), the numeric
+        allocations DataFrame (one row per window, indexed by its Test Start, one column per ticker) and the dict of
+        whole-run metrics (Metrics.run_metrics, with Max Drawdown and Average Turnover)
+    reopt_threshold: Optional, keep the allocations of the last solve, without solving, while the drift of the window's
+        estimates from those of the last solve stays below this threshold (the first window is always solved)
+    reopt_metric: drift measure of reopt_threshold,
+        'frobenius': the larger of the relative Frobenius change of the covariance matrix and the relative change
+            of the mean daily returns
+        'sharpe': the relative Sharpe ratio loss of the last solve's allocations, evaluated on the new window
+            against the Sharpe ratio they had on the window they were solved on
+    membership: Optional, DataLoader.Membership point-in-time universe. Only the tickers that were members between sd and
+        ed are loaded, and each window optimizes over the tickers that were members as of its rebalance date (test start)
+        with prices over its whole training and test period, instead of the tickers with prices over the whole back-test
+    covariance_cache: Optional, RiskModel.CovarianceCache; the Sample and Ledoit-Wolf estimators of each window are computed
+        together once (RollingCovariance.estimators or RiskModel.covariance_estimators) and served from it to the back-tests
+        of the other risk models on the same tickers and window (not used with batch_cov or risk_matrix='Factor').
+        A window the cache would not keep (read-only, or over its budget) only estimates the risk model's own covariance
+    window_workers: Optional, number of processes or threads solving the windows in parallel, each with an equal share of
+        the cores for BLAS; requires warm_start=False and no reopt_threshold, which make every window depend on the previous
+        one. The covariance matrices are still estimated in date order in this process, through the same incremental_cov,
+        batch_cov or covariance_cache path as the serial loop, and only the solves are sent to the pool. The windows are
+        reassembled in date order: the CSV, results and metrics are those of the serial run with the same options
+    window_executor: 'process' (ProcessPoolExecutor) or 'thread' (ThreadPoolExecutor) pool of window_workers
     """
+    if reopt_metric not in ('frobenius', 'sharpe'):
+        raise ValueError(f"unknown reopt_metric {reopt_metric!r}")
+    parallel = window_workers is not None and window_workers > 1
+    if parallel and (warm_start or reopt_threshold is not None):
+        raise ValueError("window_workers needs independent windows: warm_start=False and no reopt_threshold")
+    if window_executor not in ('process', 'thread'):
+        raise ValueError(f"unknown window_executor {window_executor!r}")
+    if profiler is None:
+        profiler = NULL_PROFILER
+    run = dict(function='backtest_portfolio', risk_matrix=risk_matrix, shrink_target_method=shrink_target_method,
+               solver=solver, window_size_month=window_size_month, num_tickers=len(tickers))
+    record = profiler.record(window=None, **run)
+
     sd_fetch = (dt.datetime.strptime(sd, "%Y-%m-%d") - pd.DateOffset(months=window_size_month)).strftime("%Y-%m-%d")
-    stock_data = get_stock_data(tickers, sd_fetch, ed)
-    benchmark_data = get_stock_data([benchmark_ticker], sd, ed)
-    
-    prices = stock_data['Close'].dropna(axis=1)
-    benchmark_prices = benchmark_data['Close'][benchmark_ticker].dropna()
+    if membership is not None:
+        tickers = membership.members_between(sd, ed, tickers)
+    if panel is not None:
+        prices = panel.slice(tickers, sd_fetch, ed)
+        prices = prices.dropna(axis=1, how='all') if membership is not None else _drop_missing(prices)
+        benchmark_prices = panel.slice([benchmark_ticker], sd, ed)[benchmark_ticker].dropna()
+    else:
+        stock_data = loader(tickers, sd_fetch, ed, offline=offline)
+        benchmark_data = loader([benchmark_ticker], sd, ed, offline=offline)
+
+        prices = stock_data['Close'].dropna(axis=1, how='all' if membership is not None else 'any')
+        benchmark_prices = benchmark_data['Close'][benchmark_ticker].dropna()
     dates = prices.groupby([prices.index.year, prices.index.month]).tail(1).index
+    profiler.lap(record, 'load')
+    profiler.commit(record, num_assets=prices.shape[1], num_days=prices.shape[0])
 
-    results = []
-    portfolio_returns = []
-    benchmark_returns_series = []
+    # Daily returns of prices after the first date, train windows are row slices of it
+    if returns_store is not None:
+        if not returns_store.dates[returns_store.rows(prices.index[0], prices.index[-1])].equals(prices.index[1:]):
+            raise ValueError("returns_store dates do not match the price dates")
+        all_returns = returns_store.window(prices.index[0], prices.index[-1], prices.columns)
+    else:
+        all_returns = prices.pct_change(fill_method=None).values[1:].astype(dtype, copy=False)
+    returns_index = prices.index[1:]
+    if risk_matrix == 'Factor' or membership is not None:
+        incremental_cov = batch_cov = False
+    # RollingCovariance accumulates in float64, a reduced precision estimates each window from its own returns
+    if np.dtype(dtype) != np.float64:
+        incremental_cov = False
 
+    windows = []
     for start_idx in range(0, len(dates) - window_size_month - step_size_month, step_size_month):
         train_start_date = dates[start_idx]
         test_start_date = dates[start_idx + window_size_month]
         train_end_date = test_start_date-pd.DateOffset(days=1)
         test_end_date = min(dates[start_idx + window_size_month + step_size_month]-pd.DateOffset(days=1), prices.index[-1])
+        # Training returns are those after train_start_date up to train_end_date, as train_prices.pct_change().dropna()
+        train_rows = (returns_index.searchsorted(train_start_date, side='right'), returns_index.searchsorted(train_end_date, side='right'))
+        # Test prices are the rows [test_rows[0], test_rows[1]) of prices
+        test_rows = (prices.index.searchsorted(test_start_date), prices.index.searchsorted(test_end_date, side='right'))
+        windows.append((train_start_date, train_end_date, test_start_date, test_end_date, train_rows, test_rows))
+
+    # Columns of each window: the members as of its rebalance date with prices from its training start to its test end
+    window_columns = [slice(None)] * len(windows)
+    if membership is not None:
+        members = membership.mask([window[2] for window in windows], prices.columns)
+        missing = np.concatenate([np.zeros((1, prices.shape[1]), dtype=np.int64), np.cumsum(prices.isna().values, axis=0)])
+        first_rows = prices.index.searchsorted([window[0] for window in windows])
+        last_rows = np.array([window[-1][1] for window in windows])
+        complete = missing[last_rows] == missing[first_rows]
+        window_columns = [np.flatnonzero(row) for row in members & complete]
+
+    if batch_cov:
+        record = profiler.record(window=None, **run)
+        cov_matrices = batch_covariance(all_returns, [train_rows for *_, train_rows, _ in windows], risk_matrix, shrink_target_method, dtype=dtype)
+        profiler.lap(record, 'covariance')
+        profiler.commit(record, num_windows=len(windows))
+    elif incremental_cov:
+        # The cross moments of the 'avgcorr' target are only kept when the cache can store every estimator
+        rolling_cov = RollingCovariance(prices.shape[1], cross_moments=(
+            covariance_cache is not None and risk_matrix != 'Factor' and covariance_cache.accepts(prices.shape[1], dtype)) or
+            (risk_matrix == 'LedoitWolf' and shrink_target_method != 'identity'))
+
+    def estimate_covariance(w, train_start_date, train_end_date, train_rows, columns):
+        """
+        Covariance matrix of window w from the batch, the cache, the rolling moments or the window's own returns; every
+        estimator is only computed on a cache miss the cache will keep, otherwise just the risk model's own
+        """
+        covariances = None
+        if covariance_cache is not None and risk_matrix != 'Factor' and not batch_cov:
+            window_tickers = prices.columns[columns]
+            key = (tuple(window_tickers), train_start_date, train_end_date, np.dtype(dtype).str)
+            covariances = covariance_cache.get(key)
+            if (covariances is None and covariance_cache.accepts(len(window_tickers), dtype) and
+                    (not incremental_cov or rolling_cov.cross_moments)):
+                if incremental_cov:
+                    rolling_cov.roll_to(all_returns, *train_rows)
+                    covariances, _ = rolling_cov.estimators()
+                else:
+                    covariances, _ = RiskModel(dtype).covariance_estimators(all_returns[train_rows[0]:train_rows[1], columns])
+                covariance_cache.put(key, covariances)
+        if batch_cov:
+            return cov_matrices[w]
+        if covariances is not None:
+            return covariances[estimator_name(risk_matrix, shrink_target_method)]
+        if incremental_cov:
+            rolling_cov.roll_to(all_returns, *train_rows)
+            if risk_matrix == 'Sample':
+                return rolling_cov.sample_covariance()
+            if risk_matrix == 'LedoitWolf':
+                cov_matrix, _, _, _ = rolling_cov.shrinkage_covariance(shrink_target_method=shrink_target_method)
+                return cov_matrix
+            if risk_matrix == 'LedoitWolfSkLearn':
+                cov_matrix, _ = rolling_cov.ledoit_wolf()
+                return cov_matrix
+        return _window_covariance(all_returns[train_rows[0]:train_rows[1], columns], risk_matrix, shrink_target_method,
+                                  dtype, num_factors)
+
+    # Allocations, model volatility, solve info and stage timings of every window: the covariance matrices are estimated
+    # here in date order, as in the serial loop, and handed to the window pool as they come, which solves them meanwhile
+    window_solutions = None
+    if parallel:
+        covariance_times = []
+
+        def solve_tasks():
+            for w, ((train_start_date, train_end_date, _, _, train_rows, _), columns) in enumerate(zip(windows, window_columns)):
+                start_time = time.perf_counter()
+                cov_matrix = estimate_covariance(w, train_start_date, train_end_date, train_rows, columns)
+                covariance_times.append(time.perf_counter() - start_time)
+                yield train_start_date, train_end_date, columns, cov_matrix
+
+        window_solutions = _solve_windows(dict(prices=prices, solver=solver), solve_tasks(), window_workers, window_executor)
+
+    results = []
+    window_allocs = []
+    prev_allocs = None
+    # Estimates of the window of the last solve, the reference of the drift
+    solved_cov = solved_mean = solved_sr = None
+
+    for (train_start_date, train_end_date, test_start_date, test_end_date, train_rows, test_rows), columns in zip(windows, window_columns):
+        record = profiler.record(window=len(results), train_start=train_start_date, test_start=test_start_date, **run)
         
         # Training and test window data
-        train_prices = prices.loc[train_start_date:train_end_date]
-        test_prices = prices.loc[test_start_date:test_end_date]
-        benchmark_test_prices = benchmark_prices.loc[test_start_date:test_end_date]
-
-        train_returns = train_prices.pct_change().dropna().values
-
-        # Estimate covariance matrix
-        if risk_matrix == 'Sample':
-            cov_matrix = np.cov(train_returns, rowvar=False)
-        elif risk_matrix == 'LedoitWolf':
-            rm = RiskModel()
-            cov_matrix, _, _, _ = rm.shrinkage_covariance(returns=train_returns, shrink_target_method=shrink_target_method)
-        elif risk_matrix == 'LedoitWolfSkLearn':
-            lw = LedoitWolf()
-            cov_matrix = lw.fit(train_returns).covariance_
-
-        # Find optimal allocations
-        allocs = fit_alloc(train_prices, cov_matrix, error_fct)
-
-        # Evaluate performance on the test set
-        cr, adr, sddr, sr = assess_portfolio(test_prices, allocs, cov_matrix)
-
-        # Compute test set returns for IC and IR
-        test_returns = test_prices.pct_change().dropna().dot(allocs)
-        portfolio_returns.extend(test_returns)
-        benchmark_returns = benchmark_test_prices.pct_change().dropna()
-        benchmark_returns_series.extend(benchmark_returns)
-        benchmark_cr = (benchmark_test_prices.iloc[-1] / benchmark_test_prices.iloc[0]) - 1
-
-        # Information Ratio (IR)
-        active_returns = test_returns - benchmark_returns
-        ir = active_returns.mean() * np.sqrt(252) / active_returns.std() if active_returns.std() > 0 else None
-
-        # Information Coefficient (IC)
-        ic = np.corrcoef(test_returns, benchmark_returns)[0, 1] if len(test_returns) > 0 else None
+        train_prices = prices.loc[train_start_date:train_end_date].iloc[:, columns]
+        profiler.lap(record, 'slice')
+
+        drift = None
+        if window_solutions is not None:
+            # Estimated above and solved by the window pool, with the stage timings
+            allocs, sddr, solve_info, timings = window_solutions[len(results)]
+            timings = dict(timings, covariance_time=covariance_times[len(results)])
+        else:
+            timings = {}
+            # Estimate covariance matrix from the daily returns of the training window
+            cov_matrix = estimate_covariance(len(results), train_start_date, train_end_date, train_rows, columns)
+            profiler.lap(record, 'covariance')
+
+            # Drift of the window's estimates from those of the last solve, allocations of another universe are always re-solved
+            same_universe = prev_allocs is not None and prev_allocs.index.equals(train_prices.columns)
+            if reopt_threshold is not None:
+                if reopt_metric == 'frobenius':
+                    dense_cov = cov_matrix.to_dense() if isinstance(cov_matrix, FactorCovariance) else cov_matrix
+                    dense_cov = np.asarray(dense_cov, dtype=np.float64)
+                    mean_returns = all_returns[train_rows[0]:train_rows[1], columns].mean(axis=0, dtype=np.float64)
+                    if same_universe:
+                        drift = max(np.linalg.norm(dense_cov - solved_cov) / np.linalg.norm(solved_cov),
+                                    np.linalg.norm(mean_returns - solved_mean) / np.linalg.norm(solved_mean))
+                else:
+                    objective = SharpeObjective(train_prices.values, cov_matrix)
+                    if same_universe:
+                        drift = (solved_sr + objective(prev_allocs.values)[0]) / abs(solved_sr)
+                profiler.lap(record, 'drift')
+
+            if drift is not None and drift < reopt_threshold:
+                # Estimates within the threshold: hold the allocations of the last solve
+                allocs = prev_allocs.values
+                solve_info = {'solver': None, 'nit': 0, 'nfev': 0, 'time': 0.0}
+            else:
+                # Find optimal allocations, starting from the previous window's allocations of the surviving tickers
+                ini_guess = None
+                if warm_start and prev_allocs is not None:
+                    ini_guess = prev_allocs.reindex(train_prices.columns, fill_value=0).values
+                    ini_guess = ini_guess / ini_guess.sum() if ini_guess.sum() > 0 else None
+                allocs, solve_info = fit_alloc(train_prices, cov_matrix, solver=solver, ini_guess=ini_guess, return_info=True)
+                prev_allocs = pd.Series(allocs, index=train_prices.columns)
+                if reopt_threshold is not None:
+                    if reopt_metric == 'frobenius':
+                        solved_cov, solved_mean = dense_cov, mean_returns
+                    else:
+                        solved_sr = -objective(allocs)[0]
+            profiler.lap(record, 'optimize')
+
+            # Model volatility of the allocations, the test set performance is evaluated for every window at once below
+            sddr = _model_volatility(allocs, cov_matrix)
+        window_allocs.append(np.zeros(prices.shape[1]))
+        window_allocs[-1][columns] = allocs
 
         results.append({
             "Train Start": train_start_date,
             "Train End": train_end_date,
             "Test Start": test_start_date,
             "Test End": test_end_date,
-            "Cumulative Return": cr,
-            "Benchmark Cumulative Return": benchmark_cr,
-            "Average Daily Return": adr,
             "Standard Deviation": sddr,
-            "Sharpe Ratio": sr,
-            "Information Ratio": ir,
-            "Information Coefficient": ic,
-            "Optimal Allocations": [
-                f"{ticker}: {alloc:.4f}" for ticker, alloc in zip(tickers, allocs) if round(alloc, 4) != 0
-            ]
+            "Solver Iterations": solve_info['nit'],
+            "Solver Evaluations": solve_info['nfev'],
+            "Reoptimized": solve_info['solver'] is not None,
+            "Drift": drift,
         })
 
-        print(f'Train from {train_start_date} to {train_end_date} and Test from {test_start_date} to {test_end_date} completed...')
+        profiler.commit(record, solver_used=solve_info['solver'], nit=solve_info['nit'], nfev=solve_info['nfev'], drift=drift, **timings,
+                        num_assets=train_prices.shape[1], num_train_days=train_prices.shape[0] - 1, num_test_days=test_rows[1] - test_rows[0])
+
+        if not profiler.enabled:
+            print(f'Train from {train_start_date} to {train_end_date} and Test from {test_start_date} to {test_end_date} completed...')
     
-    # Save results to CSV
+    # Test set performance of every window at once, timed as one run-level 'metrics' stage
+    record = profiler.record(window=None, **run)
+    # Daily returns of every test window, concatenated: window w owns [bounds[w], bounds[w + 1])
+    allocs_matrix = np.array(window_allocs, dtype=np.float64)
+    test_starts = np.array([window[-1][0] for window in windows])
+    test_ends = np.array([window[-1][1] for window in windows])
+    bounds = np.concatenate([[0], np.cumsum(test_ends - test_starts - 1)])
+    value_rows = np.concatenate([np.arange(start, end) for start, end in zip(test_starts, test_ends)])
+    value_ids = np.repeat(np.arange(len(windows)), test_ends - test_starts)
+    daily = np.ones(len(value_rows), dtype=bool)
+    daily[np.cumsum(test_ends - test_starts) - (test_ends - test_starts)] = False
+
+    price_values = prices.values
+    benchmark_values = benchmark_prices.reindex(prices.index).values
+    # Buy-and-hold value of each window's allocations (assess_portfolio) and the daily-rebalanced returns of IR and IC;
+    # prices missing outside a window's universe (membership) only meet zero allocations
+    normed = np.nan_to_num(price_values[value_rows] / price_values[test_starts][value_ids])
+    port_val = np.einsum('ij,ij->i', normed, allocs_matrix[value_ids])
+    portfolio_daily = (port_val[1:] / port_val[:-1] - 1)[daily[1:]]
+    asset_daily = np.nan_to_num(price_values[value_rows[daily]] / price_values[value_rows[daily] - 1] - 1)
+    rebalanced_daily = np.einsum('ij,ij->i', asset_daily, allocs_matrix[value_ids[daily]])
+    benchmark_daily = benchmark_values[value_rows[daily]] / benchmark_values[value_rows[daily] - 1] - 1
+
+    per_window = window_metrics(portfolio_daily, benchmark_daily, bounds, rebalanced_daily)
+    turnovers = turnover(allocs_matrix, np.nan_to_num(price_values[test_ends - 1] / price_values[test_starts]))
+    metrics = run_metrics(per_window["Cumulative Return"], per_window["Benchmark Cumulative Return"], len(tickers),
+                          daily_returns=portfolio_daily, turnovers=turnovers)
+
     df_results = pd.DataFrame(results)
-    df_results["Optimal Allocations"] = df_results["Optimal Allocations"].apply(
-        lambda x: ", ".join(sorted(x, key=lambda alloc: float(alloc.split(": ")[1]), reverse=True)))
-    
-    cum_return = df_results['Cumulative Return'].apply(lambda x: x+1).prod()-1
-    annualized_return = (cum_return+1)**(12/len(df_results))-1
-    annualized_std_dev = df_results['Cumulative Return'].std()*np.sqrt(12)
-    sharpe_ratio = annualized_return / annualized_std_dev
-
-    active_returns = df_results['Cumulative Return'] - df_results['Benchmark Cumulative Return']
-    cum_active_return = active_returns.apply(lambda x: x+1).prod()-1
-    annualized_active_return = (cum_active_return+1)**(12/len(df_results))-1
-    annualized_active_std_dev = active_returns.std()*np.sqrt(12)
-    ir = annualized_active_return / annualized_active_std_dev
-
-    # Compute Information Coefficient (IC)
-    breadth = 12 * len(tickers)
-    # ic = np.corrcoef(portfolio_returns, benchmark_returns_series)[0, 1] if len(portfolio_returns) > 0 else None
-    ic = ir / np.sqrt(breadth)
+    df_results.insert(4, "Cumulative Return", per_window["Cumulative Return"])
+    df_results.insert(5, "Benchmark Cumulative Return", per_window["Benchmark Cumulative Return"])
+    df_results.insert(6, "Average Daily Return", per_window["Average Daily Return"])
+    df_results.insert(8, "Sharpe Ratio", np.sqrt(252) * per_window["Average Daily Return"] / df_results["Standard Deviation"].values)
+    df_results.insert(9, "Information Ratio", per_window["Information Ratio"])
+    df_results.insert(10, "Information Coefficient", per_window["Information Coefficient"])
+    df_results.insert(11, "Max Drawdown", per_window["Max Drawdown"])
+    df_results.insert(12, "Turnover", turnovers)
+    df_results["Optimal Allocations"] = format_allocations(allocs_matrix, prices.columns)
+    profiler.lap(record, 'metrics')
+    profiler.commit(record, num_windows=len(windows))
+
+    cum_return = metrics["Cumulative Return"]
+    annualized_return = metrics["Annualized Return"]
+    annualized_std_dev = metrics["Standard Deviation"]
+    sharpe_ratio = metrics["Sharpe Ratio"]
+    ir = metrics["Information Ratio"]
+    ic = metrics["Information Coefficient"]
 
     print(f"Cumulative Return: {cum_return:.4f}")
     print(f"Annualized Return: {annualized_return:.4f}")
@@ -222,22 +912,35 @@ def backtest_portfolio(sd='2014-12-31', ed='2024-12-31', tickers=["AAPL", "MSFT"
     print(f"Sharpe Ratio: {sharpe_ratio:.4f}")
     print(f"Information Ratio (IR): {ir:.4f}")
     print(f"Information Coefficient (IC): {ic:.4f}")
+    print(f"Max Drawdown: {metrics['Max Drawdown']:.4f}, Average Turnover: {metrics['Average Turnover']:.4f}")
+    print(f"Solver Iterations: {df_results['Solver Iterations'].sum()}, Solver Evaluations: {df_results['Solver Evaluations'].sum()}")
+    if reopt_threshold is not None:
+        num_skipped = (~df_results['Reoptimized']).sum()
+        print(f"Skipped Solves: {num_skipped} of {len(df_results)} ({reopt_metric} drift < {reopt_threshold})")
 
     if risk_matrix == 'LedoitWolf':
         filename = f'backtest_results_N={len(tickers)}_wd={window_size_month}_rm={risk_matrix}+{shrink_target_method}.csv'
+    elif risk_matrix == 'Factor':
+        filename = f'backtest_results_N={len(tickers)}_wd={window_size_month}_rm={risk_matrix}+{num_factors}.csv'
     else:
         filename = f'backtest_results_N={len(tickers)}_wd={window_size_month}_rm={risk_matrix}.csv'
+    if membership is not None:
+        filename = filename.replace('.csv', '_pit.csv')
     df_results.to_csv('result/' + filename, index=False)
 
     print(f"Backtesting completed. Results saved to {filename}")
 
+    if return_results:
+        # Numeric allocations (W, n), next to the formatted ones
+        allocations = allocations_frame(allocs_matrix, prices.columns, index=df_results["Test Start"])
+        return cum_return, annualized_return, annualized_std_dev, sharpe_ratio, ir, ic, df_results, allocations, metrics
     return cum_return, annualized_return, annualized_std_dev, sharpe_ratio, ir, ic
 
 if __name__ == "__main__":
 
     """ Rolling window back-testing """
     
-    sp500_tickers = fetch_sp500_companies()
+    sp500_tickers = load_universe()
     
     # Parameters for testing
     start_date = '2014-12-31'
@@ -248,6 +951,7 @@ if __name__ == "__main__":
     shrink_target_methods = ["identity", "avgcorr"]  # Example methods, adjust based on your code
     results = []
     delay=2
+    offline = False  # Serve prices from the local cache only (fill it with one online run first)
 
     # stock_count=len(sp500_tickers); wd=60; risk_matrix="LedoitWolfSkLearn"; shrink_target_method="avgcorr"
     
@@ -263,7 +967,7 @@ if __name__ == "__main__":
                         print(f"Testing [{stock_count}] stocks with window [{wd}] months using [{risk_matrix}] with target method [{shrink_target_method}]...")
                         
                         try:
-                            cr, ar, astd, sr, ir, ic = backtest_portfolio(start_date, end_date, tickers_subset, risk_matrix, shrink_target_method, wd)
+                            cr, ar, astd, sr, ir, ic = backtest_portfolio(start_date, end_date, tickers_subset, risk_matrix, shrink_target_method, wd, offline=offline)
                             
                             result = {
                                 "Stock Count": stock_count,
@@ -284,13 +988,14 @@ if __name__ == "__main__":
                         except Exception as e:
                             print(f"Error for {stock_count} stocks, {wd} months, {risk_matrix}, {shrink_target_method}: {e}")
 
-                    time.sleep(delay + random.uniform(0, 1))
+                    if not offline:
+                        time.sleep(delay + random.uniform(0, 1))
 
                 else:
                     print(f"Testing [{stock_count}] stocks with window [{wd}] months using [{risk_matrix}]...")
                         
                     try:
-                        cr, ar, astd, sr, ir, ic = backtest_portfolio(start_date, end_date, tickers_subset, risk_matrix, None, wd)
+                        cr, ar, astd, sr, ir, ic = backtest_portfolio(start_date, end_date, tickers_subset, risk_matrix, None, wd, offline=offline)
                         
                         result = {
                             "Stock Count": stock_count,
@@ -311,7 +1016,8 @@ if __name__ == "__main__":
                     except Exception as e:
                         print(f"Error for {stock_count} stocks, {wd} months, {risk_matrix}: {e}")
 
-                    time.sleep(delay + random.uniform(0, 1))
+                    if not offline:
+                        time.sleep(delay + random.uniform(0, 1))
                     
 
     # Save results to CSV
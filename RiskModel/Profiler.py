@@ -0,0 +1,66 @@
+import json
+import time
+import pandas as pd
+
+class Profiler:
+    """
+    In-memory sink for per-window stage timings and counters of backtest_portfolio and optimize_portfolio
+
+    Each record is a flat dict of context fields (run, window dates), '<stage>_time' wall times in seconds
+    and counters such as optimizer iterations, function evaluations and matrix sizes.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, **fields):
+        """
+        Start a new record with the given context fields, its clock starts now
+        """
+        record = dict(fields)
+        record['_clock'] = time.perf_counter()
+        return record
+
+    def lap(self, record, stage):
+        """
+        Store the wall time since the last lap (or the start of the record) as '<stage>_time'
+        """
+        now = time.perf_counter()
+        record[f'{stage}_time'] = now - record['_clock']
+        record['_clock'] = now
+
+    def commit(self, record, **counters):
+        """
+        Add the counters to the record and append it to the sink
+        """
+        record.pop('_clock')
+        record.update(counters)
+        self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records)
+
+    def to_csv(self, path):
+        self.to_frame().to_csv(path, index=False)
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=2, default=str)
+
+class _NullProfiler:
+    """
+    Disabled profiler, every call is a no-op
+    """
+    enabled = False
+
+    def record(self, **fields):
+        return None
+
+    def lap(self, record, stage):
+        pass
+
+    def commit(self, record, **counters):
+        pass
+
+NULL_PROFILER = _NullProfiler()
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import numbers
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+# Per-window columns of backtest_portfolio's results, stored as typed columns
+WINDOW_COLUMNS = {
+    "Train Start": "train_start",
+    "Train End": "train_end",
+    "Test Start": "test_start",
+    "Test End": "test_end",
+    "Cumulative Return": "cumulative_return",
+    "Benchmark Cumulative Return": "benchmark_cumulative_return",
+    "Average Daily Return": "average_daily_return",
+    "Standard Deviation": "standard_deviation",
+    "Sharpe Ratio": "sharpe_ratio",
+    "Information Ratio": "information_ratio",
+    "Information Coefficient": "information_coefficient",
+    "Max Drawdown": "max_drawdown",
+    "Turnover": "turnover",
+    "Solver Iterations": "solver_iterations",
+    "Solver Evaluations": "solver_evaluations",
+    "Reoptimized": "reoptimized",
+    "Drift": "drift",
+}
+# Window columns stored as integers (Reoptimized as 0/1), the others are dates (TEXT) or REAL
+INTEGER_COLUMNS = {"solver_iterations", "solver_evaluations", "reoptimized"}
+
+def _column_type(column):
+    if column.endswith(('_start', '_end')):
+        return 'TEXT'
+    return 'INTEGER' if column in INTEGER_COLUMNS else 'REAL'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_key TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    universe_hash TEXT NOT NULL,
+    num_tickers INTEGER NOT NULL,
+    start_date TEXT,
+    end_date TEXT,
+    window INTEGER,
+    risk_matrix TEXT,
+    shrink_target_method TEXT,
+    params TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (task, universe_hash, start_date, end_date, window, risk_matrix, shrink_target_method);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_key TEXT NOT NULL REFERENCES runs (run_key) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_key, metric)
+);
+CREATE INDEX IF NOT EXISTS metrics_metric ON metrics (metric);
+CREATE TABLE IF NOT EXISTS windows (
+    run_key TEXT NOT NULL REFERENCES runs (run_key) ON DELETE CASCADE,
+    window INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (run_key, window)
+);
+CREATE TABLE IF NOT EXISTS allocations (
+    run_key TEXT NOT NULL REFERENCES runs (run_key) ON DELETE CASCADE,
+    window INTEGER NOT NULL,
+    ticker TEXT NOT NULL,
+    weight REAL NOT NULL,
+    PRIMARY KEY (run_key, window, ticker)
+);
+""" % ",\n    ".join(f"{column} {_column_type(column)}" for column in WINDOW_COLUMNS.values())
+
+def universe_hash(tickers):
+    """
+    Hash of the ordered ticker list of a configuration
+    """
+    return hashlib.sha1(json.dumps(list(tickers)).encode()).hexdigest()[:16]
+
+def _date(value):
+    return None if value is None else pd.Timestamp(value).strftime("%Y-%m-%d")
+
+def _number(value):
+    return None if value is None or pd.isna(value) else float(value)
+
+def _window_value(column, value):
+    if _column_type(column) == 'TEXT':
+        return _date(value)
+    if _column_type(column) == 'INTEGER':
+        return None if value is None or pd.isna(value) else int(value)
+    return _number(value)
+
+class ResultsStore:
+    """
+    Keyed, resumable results of back-test sweeps in a SQLite database
+
+    A run is keyed by its task and configuration: the hash of the universe, the date range, the window,
+    the risk model, the shrink target and any other parameter (solver, ...). Each run keeps its result
+    row, its numeric metrics in long form (runs x metrics) and, for rolling-window back-tests, one typed
+    record per window with the allocations in long form (window x ticker), so aggregates across runs
+    are plain SQL queries.
+    """
+    def __init__(self, path='result/results.sqlite'):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        # Stores created before a window column existed get it added, empty for the runs already stored
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(windows)")}
+        for column in WINDOW_COLUMNS.values():
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE windows ADD COLUMN {column} {_column_type(column)}")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def key_fields(task, config):
+        """
+        Key columns of a configuration (see Sweep.grid_configs), with its remaining parameters as JSON
+        """
+        params = {name: value for name, value in config.items()
+                  if name not in ('tickers', 'stock_count', 'period', 'risk_matrix', 'shrink_target_method', 'start_date', 'end_date')}
+        return {
+            "task": task,
+            "universe_hash": universe_hash(config['tickers']),
+            "num_tickers": len(config['tickers']),
+            "start_date": _date(config.get('start_date')),
+            "end_date": _date(config.get('end_date')),
+            "window": config.get('period'),
+            "risk_matrix": config.get('risk_matrix'),
+            "shrink_target_method": config.get('shrink_target_method') or '',
+            "params": json.dumps(params, sort_keys=True, default=str),
+        }
+
+    @classmethod
+    def run_key(cls, task, config):
+        return hashlib.sha1(json.dumps(cls.key_fields(task, config), sort_keys=True).encode()).hexdigest()
+
+    def has(self, task, config):
+        return self.conn.execute("SELECT 1 FROM runs WHERE run_key = ?", (self.run_key(task, config),)).fetchone() is not None
+
+    def get(self, task, config):
+        """
+        Stored result row of a configuration, or None
+        """
+        row = self.conn.execute("SELECT result FROM runs WHERE run_key = ?", (self.run_key(task, config),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_windows(self, task, config):
+        """
+        Stored per-window results of a configuration with backtest_portfolio's column names (without the formatted
+        allocations, see the allocations table), or None if it has none
+        """
+        records = self.windows(self.run_key(task, config))
+        if records.empty:
+            return None
+        windows = records[list(WINDOW_COLUMNS.values())].set_axis(list(WINDOW_COLUMNS), axis=1)
+        for name, column in WINDOW_COLUMNS.items():
+            if _column_type(column) == 'TEXT':
+                windows[name] = pd.to_datetime(windows[name])
+        # Runs stored before the column existed keep their unknown (NULL) values
+        if windows["Reoptimized"].notna().all():
+            windows["Reoptimized"] = windows["Reoptimized"].astype(bool)
+        return windows
+
+    def put(self, task, config, result, windows=None, allocations=None):
+        """
+        Store (or replace) the result row of a configuration and its per-window results
+
+        :param:
+            task: name of the task, e.g. 'rolling_window_task'
+            config: configuration of the run (see Sweep.grid_configs)
+            result: result row of the task
+            windows: Optional, per-window results DataFrame of backtest_portfolio
+            allocations: Optional, numeric allocations DataFrame of backtest_portfolio (windows x tickers), stored
+                instead of the formatted Optimal Allocations of windows
+        :return:
+            run key
+        """
+        fields = self.key_fields(task, config)
+        run_key = self.run_key(task, config)
+        metrics = [(run_key, name, _number(value)) for name, value in result.items()
+                   if isinstance(value, numbers.Number) or value is None]
+
+        with self.conn:
+            self.conn.execute("DELETE FROM runs WHERE run_key = ?", (run_key,))
+            self.conn.execute(f"INSERT INTO runs (run_key, {', '.join(fields)}, result, created_at) "
+                              f"VALUES ({', '.join('?' * (len(fields) + 3))})",
+                              (run_key, *fields.values(), json.dumps(result, default=float), time.time()))
+            self.conn.executemany("INSERT INTO metrics VALUES (?, ?, ?)", metrics)
+
+            if windows is not None:
+                columns = [column for column in WINDOW_COLUMNS if column in windows.columns]
+                records = []
+                for window, row in enumerate(windows[columns].itertuples(index=False)):
+                    records.append((run_key, window) + tuple(
+                        _window_value(WINDOW_COLUMNS[column], value) for column, value in zip(columns, row)))
+                self.conn.executemany(f"INSERT INTO windows (run_key, window, {', '.join(WINDOW_COLUMNS[c] for c in columns)}) "
+                                      f"VALUES ({', '.join('?' * (len(columns) + 2))})", records)
+
+                if allocations is not None:
+                    # Numeric (W, n) allocations of backtest_portfolio, the weights that round to zero are left out
+                    window_index, ticker_index = np.nonzero(np.round(allocations.values, 4))
+                    self.conn.executemany("INSERT INTO allocations VALUES (?, ?, ?, ?)", [
+                        (run_key, int(window), allocations.columns[ticker], float(allocations.values[window, ticker]))
+                        for window, ticker in zip(window_index, ticker_index)
+                    ])
+                elif "Optimal Allocations" in windows.columns:
+                    self.conn.executemany("INSERT INTO allocations VALUES (?, ?, ?, ?)", [
+                        (run_key, window, ticker, float(weight))
+                        for window, allocations in enumerate(windows["Optimal Allocations"])
+                        for ticker, weight in (item.rsplit(": ", 1) for item in
+                                               (allocations.split(", ") if isinstance(allocations, str) else allocations) if item)
+                    ])
+        return run_key
+
+    def query(self, sql, params=()):
+        """
+        Result of a SQL query over the runs, metrics, windows and allocations tables as a DataFrame
+        """
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def results(self, task):
+        """
+        Stored result rows of a task, in the order they were computed (the rows of the old summary CSVs)
+        """
+        rows = self.conn.execute("SELECT result FROM runs WHERE task = ? ORDER BY created_at", (task,)).fetchall()
+        return pd.DataFrame([json.loads(row[0]) for row in rows])
+
+    def metrics(self, task=None):
+        """
+        One row per run with its key columns and one column per numeric metric
+        """
+        sql = ("SELECT runs.run_key, task, universe_hash, num_tickers, start_date, end_date, window, risk_matrix, "
+               "shrink_target_method, params, metric, value FROM runs JOIN metrics USING (run_key)")
+        long = self.query(sql + (" WHERE task = ?" if task else "") + " ORDER BY created_at", (task,) if task else ())
+        keys = long.drop(columns=['metric', 'value']).drop_duplicates('run_key').set_index('run_key')
+        wide = long.pivot(index='run_key', columns='metric', values='value')
+        return keys.join(wide).reset_index()
+
+    def windows(self, run_key=None):
+        """
+        Per-window records of one run, or of every run
+        """
+        if run_key is None:
+            return self.query("SELECT * FROM windows ORDER BY run_key, window")
+        return self.query("SELECT * FROM windows WHERE run_key = ? ORDER BY window", (run_key,))
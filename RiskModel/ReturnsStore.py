@@ -0,0 +1,89 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+class ReturnsStore:
+    """
+    Daily returns of a universe, computed once and kept as a memory-mapped (dates x tickers) matrix
+
+    The store is a directory with returns.npy (T, n), dates.npy and tickers.json. Opened read-only,
+    the matrix is shared through the page cache by every process reading it, and windows over a
+    date range and a prefix of the tickers are zero-copy views.
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.returns = np.load(os.path.join(path, 'returns.npy'), mmap_mode=mode)
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(path, 'dates.npy')), name='Date')
+        with open(os.path.join(path, 'tickers.json')) as f:
+            self.tickers = pd.Index(json.load(f), name='Ticker')
+
+    @classmethod
+    def build(cls, prices, path, dtype=np.float64, block_size=4096):
+        """
+        Compute the daily returns of prices (dates x tickers) and write them to a store at path
+
+        Returns are computed block by block straight into the memory map, as prices.pct_change()
+        without the first row; a return is NaN where either price is missing. dtype=np.float32 halves
+        the size of the store and of every window read from it.
+        """
+        os.makedirs(path, exist_ok=True)
+        values = prices.values
+        T, n = values.shape[0] - 1, values.shape[1]
+
+        returns = np.lib.format.open_memmap(os.path.join(path, 'returns.npy'), mode='w+', dtype=dtype, shape=(T, n))
+        for start in range(0, T, block_size):
+            end = min(start + block_size, T)
+            returns[start:end] = values[start + 1:end + 1] / values[start:end] - 1
+        returns.flush()
+        del returns
+
+        np.save(os.path.join(path, 'dates.npy'), prices.index[1:].values.astype('datetime64[ns]'))
+        with open(os.path.join(path, 'tickers.json'), 'w') as f:
+            json.dump(list(prices.columns), f)
+        return cls(path)
+
+    @property
+    def dtype(self):
+        return self.returns.dtype
+
+    def columns(self, tickers):
+        """
+        Column selector for tickers: a slice if they are a contiguous run of the store's tickers, else positions
+
+        Raises KeyError for tickers that are not in the store.
+        """
+        tickers = list(tickers)
+        if not tickers:
+            return slice(0, 0)
+        positions = self.tickers.get_indexer(tickers)
+        if (positions < 0).any():
+            raise KeyError(f"tickers not in the returns store: {[t for t, i in zip(tickers, positions) if i < 0]}")
+        first = int(positions[0])
+        if list(self.tickers[first:first + len(tickers)]) == tickers:
+            return slice(first, first + len(tickers))
+        return positions
+
+    def rows(self, start_date, end_date):
+        """
+        Row slice of the returns dated in (start_date, end_date], i.e. the returns of prices.loc[start_date:end_date]
+        """
+        return slice(self.dates.searchsorted(pd.Timestamp(start_date), side='right'),
+                     self.dates.searchsorted(pd.Timestamp(end_date), side='right'))
+
+    def window(self, start_date, end_date, tickers=None):
+        """
+        Returns of prices.loc[start_date:end_date, tickers] as an array (zero-copy for contiguous tickers)
+        """
+        rows = self.rows(start_date, end_date)
+        if tickers is None:
+            return self.returns[rows]
+        return self.returns[rows, self.columns(tickers)]
+
+    def frame(self, start_date, end_date, tickers=None):
+        """
+        window() as a DataFrame with its dates and tickers
+        """
+        rows = self.rows(start_date, end_date)
+        columns = self.tickers if tickers is None else pd.Index(list(tickers), name='Ticker')
+        return pd.DataFrame(self.window(start_date, end_date, tickers), index=self.dates[rows], columns=columns, copy=False)
@@ -1,15 +1,371 @@
+import hashlib
+import os
+import shutil
 import numpy as np
 
+def _diagonal(mat):
+    return np.diagonal(mat, axis1=-2, axis2=-1)
+
+def _frobenius_squared(mat):
+    return np.einsum('...ij,...ij->...', mat, mat)
+
+def _shrinkage_from_moments(T, cov_var_sample, shrink_target_method, row_norm_fourth_sum=None, fourth_moment=None, third_moment=None):
+    """
+    Shrinkage estimator from the centered moments of the returns
+
+    All matrix arguments may carry a leading batch axis (W,n,n), with T, row_norm_fourth_sum and the
+    results then of shape (W,).
+
+    :param:
+        T: number of observations
+        cov_var_sample: sample covariance matrix X'X / T of the centered returns X (n,n)
+        shrink_target_method: 'avgcorr' or 'identity'
+        row_norm_fourth_sum: sum_t ||X_t||^4, needed for 'identity'
+        fourth_moment: (X ** 2)'(X ** 2) / T (n,n), needed for 'avgcorr'
+        third_moment: (X ** 3)'X / T (n,n), needed for 'avgcorr'
+    :return:
+        S_hat: shrinkage estimator of the covariance matrix
+        corr_avg: sample average correlation
+        beta_hat: shrinkage slope
+    """
+    n = cov_var_sample.shape[-1]
+    # everything is computed in the precision of the moments
+    eye = np.eye(n, dtype=cov_var_sample.dtype)
+    T = np.asarray(T, dtype=cov_var_sample.dtype)
+    corr_avg = np.zeros_like(T)
+
+    if shrink_target_method == 'identity':
+        var_mean = _diagonal(cov_var_sample).mean(axis=-1)
+        shrink_target = var_mean[..., None, None] * eye
+
+        # sum_t ||X_t X_t' - S||^2 = sum_t ||X_t||^4 - 2 sum_t X_t' S X_t + T ||S||^2 = sum_t ||X_t||^4 - T ||S||^2
+        omega_hat_squared_sum = row_norm_fourth_sum - T * _frobenius_squared(cov_var_sample)
+        omega_hat_squared = omega_hat_squared_sum / (T * (T - 1))
+
+        beta_hat = 1 - omega_hat_squared / _frobenius_squared(cov_var_sample - shrink_target)
+
+    else:
+        std_sample = np.sqrt(_diagonal(cov_var_sample))
+        cov_var_unit = std_sample[..., :, None] * std_sample[..., None, :]
+        corr_avg = ((cov_var_sample / cov_var_unit).sum(axis=(-2, -1)) - n) / (n * (n - 1))
+        # average correlation off the diagonal, variances on it
+        shrink_target = cov_var_unit * (corr_avg[..., None, None] * (1 - eye) + eye)
+
+        phi_mat = fourth_moment - cov_var_sample ** 2
+        phi = phi_mat.sum(axis=(-2, -1))
+
+        theta_mat = (third_moment - std_sample[..., :, None] ** 2 * cov_var_sample) * (1 - eye)
+        rho = _diagonal(phi_mat).sum(axis=-1) + corr_avg * (theta_mat / cov_var_unit).sum(axis=(-2, -1))
+
+        gamma = _frobenius_squared(cov_var_sample - shrink_target)
+        kappa = (phi - rho) / gamma
+        beta_hat = 1 - np.clip(kappa / T, 0, 1)
+
+    beta = beta_hat[..., None, None]
+    S_hat = (1 - beta) * shrink_target + beta * cov_var_sample
+
+    return S_hat, corr_avg, beta_hat
+
+def _ledoit_wolf_from_moments(T, cov_var_sample, row_norm_fourth_sum):
+    """
+    Ledoit-Wolf estimator as in sklearn.covariance.LedoitWolf, from the centered moments of the returns
+    (with an optional leading batch axis, as _shrinkage_from_moments)
+
+    :return:
+        covariance: shrunk covariance matrix (sklearn's LedoitWolf().fit(returns).covariance_)
+        shrinkage: shrinkage intensity towards the scaled identity (sklearn's shrinkage_)
+    """
+    n = cov_var_sample.shape[-1]
+    if n == 1:
+        return cov_var_sample.copy(), np.zeros(cov_var_sample.shape[:-2], dtype=cov_var_sample.dtype)
+
+    trace = _diagonal(cov_var_sample).sum(axis=-1)
+    mu = trace / n
+    delta_ = _frobenius_squared(cov_var_sample)
+    beta = (row_norm_fourth_sum / T - delta_) / (n * T)
+    delta = (delta_ - 2.0 * mu * trace + n * mu ** 2) / n
+    beta = np.minimum(beta, delta)
+    shrinkage = np.where(beta == 0, 0.0, beta / delta)
+
+    covariance = (1.0 - shrinkage)[..., None, None] * cov_var_sample + (shrinkage * mu)[..., None, None] * np.eye(n, dtype=cov_var_sample.dtype)
+    return covariance, shrinkage
+
+def _centered_moments(T, s1, M2):
+    """
+    Mean m and centered cross-product sum_t (y_t - m)(y_t - m)' from the raw sums of y (batched like _shrinkage_from_moments)
+    """
+    T = np.asarray(T, dtype=s1.dtype)
+    m = s1 / T[..., None]
+    return m, M2 - T[..., None, None] * m[..., :, None] * m[..., None, :]
+
+def _centered_row_norm_fourth_sum(T, m, s1, M2, q4, qy):
+    """
+    sum_t ||y_t - m||^4 expanded in the raw sums of y
+    """
+    mm = np.einsum('...i,...i->...', m, m)
+    return (q4 - 4 * np.einsum('...i,...i->...', m, qy) + 2 * mm * _diagonal(M2).sum(axis=-1)
+            + 4 * np.einsum('...i,...ij,...j->...', m, M2, m) - 4 * mm * np.einsum('...i,...i->...', m, s1) + T * mm ** 2)
+
+def _centered_cross_moments(T, m, s2, s3, M2, B, A22, A31):
+    """
+    sum_t (y_i - m_i)^2 (y_j - m_j)^2 and sum_t (y_i - m_i)^3 (y_j - m_j) expanded in the raw sums of y,
+    with B = (Y ** 2)'Y, A22 = (Y ** 2)'(Y ** 2) and A31 = (Y ** 3)'Y
+    """
+    T = np.asarray(T, dtype=m.dtype)[..., None, None]
+    m2 = m ** 2
+    mi, mj = m[..., :, None], m[..., None, :]
+    m2i, m2j = m2[..., :, None], m2[..., None, :]
+    BT = np.swapaxes(B, -2, -1)
+
+    C4 = A22 - 2 * B * mj - 2 * BT * mi + s2[..., :, None] * m2j + m2i * s2[..., None, :] + 4 * M2 * mi * mj - 3 * T * m2i * m2j
+    C31 = (A31 - s3[..., :, None] * mj - 3 * mi * B + 3 * (m * s2)[..., :, None] * mj
+           + 3 * m2i * M2 - 3 * T * (m2 * m)[..., :, None] * mj)
+    return C4, C31
+
+def _block_moments(returns, bounds, shift, cross_moments=True):
+    """
+    Raw sums of y = returns - shift over the row blocks [bounds[b], bounds[b + 1]), stacked along a leading block axis
+
+    Blocks are zero-padded to a common length (zero rows add nothing to the sums) so that every
+    block's cross-products are computed by one batched matmul, in the precision of shift.
+    """
+    n = returns.shape[1]
+    lengths = np.diff(bounds)
+    y = np.zeros((len(lengths), max(lengths.max(initial=0), 1), n), dtype=shift.dtype)
+    for b, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        y[b, :end - start] = returns[start:end]
+        y[b, :end - start] -= shift
+
+    y2 = y ** 2
+    q = y2.sum(axis=2)
+    y_T = y.transpose(0, 2, 1)
+    moments = {
+        'T': lengths.astype(shift.dtype),
+        's1': y.sum(axis=1),
+        'M2': np.matmul(y_T, y),
+        'q4': np.einsum('bt,bt->b', q, q),
+        'qy': np.einsum('bt,bti->bi', q, y),
+    }
+    if cross_moments:
+        y3 = y2 * y
+        y2_T = y2.transpose(0, 2, 1)
+        moments.update(s2=y2.sum(axis=1), s3=y3.sum(axis=1), B=np.matmul(y2_T, y),
+                       A22=np.matmul(y2_T, y2), A31=np.matmul(y3.transpose(0, 2, 1), y))
+    return moments
+
+def window_moments(returns, windows, cross_moments=True, chunk_size=16, dtype=np.float64):
+    """
+    Raw sums of the returns over many row windows, chunk by chunk
+
+    The union of the window boundaries cuts the rows into blocks (e.g. months for rolling windows);
+    each block's sums are computed once and a window's sums are the difference of two prefix sums
+    over the blocks, so overlapping windows share all of their work.
+
+    :param:
+        returns: returns of assets (T,n)
+        windows: sequence of (start, end) row ranges [start, end) of returns
+        cross_moments: also accumulate the squared/cubed cross-moments needed by the 'avgcorr' target
+        chunk_size: number of windows whose (n,n) sums are held in memory at once
+        dtype: floating point precision of the sums, np.float64 or np.float32
+    :return:
+        iterator of (window slice, moments) with moments a dict of the raw sums around a common shift,
+        each with a leading axis over the windows of the chunk (see RollingCovariance for their meaning)
+    """
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    if len(windows) == 0:
+        return
+    shift = returns[windows[:, 0].min():windows[:, 1].max()].mean(axis=0, dtype=np.float64).astype(dtype)
+
+    for first in range(0, len(windows), chunk_size):
+        chunk = windows[first:first + chunk_size]
+        bounds = np.unique(chunk)
+        moments = _block_moments(returns, bounds, shift, cross_moments)
+        lo, hi = np.searchsorted(bounds, chunk[:, 0]), np.searchsorted(bounds, chunk[:, 1])
+        sums = {}
+        for key, block_sums in moments.items():
+            prefix = np.empty((len(block_sums) + 1,) + block_sums.shape[1:], dtype=block_sums.dtype)
+            prefix[0] = 0
+            np.cumsum(block_sums, axis=0, out=prefix[1:])
+            sums[key] = prefix[hi] - prefix[lo]
+        yield slice(first, first + len(chunk)), sums
+
+def batch_covariance(returns, windows, risk_matrix='LedoitWolf', shrink_target_method='avgcorr', chunk_size=16, dtype=np.float64):
+    """
+    Covariance matrices of many row windows of returns, stacked (W,n,n)
+
+    :param:
+        risk_matrix: 'Sample' (np.cov), 'LedoitWolf' (RiskModel().shrinkage_covariance) or
+            'LedoitWolfSkLearn' (sklearn's LedoitWolf)
+        see window_moments for the other parameters
+    """
+    if risk_matrix == 'LedoitWolf':
+        S_hat, _, _ = RiskModel(dtype).batch_shrinkage_covariance(returns, windows, shrink_target_method, chunk_size)
+        return S_hat
+
+    n = returns.shape[1]
+    covariances = np.empty((len(windows), n, n), dtype=dtype)
+    for rows, sums in window_moments(returns, windows, cross_moments=False, chunk_size=chunk_size, dtype=dtype):
+        T = sums['T']
+        m, C2 = _centered_moments(T, sums['s1'], sums['M2'])
+        if risk_matrix == 'Sample':
+            covariances[rows] = C2 / (T - 1)[:, None, None]
+        elif risk_matrix == 'LedoitWolfSkLearn':
+            row_norm_fourth_sum = _centered_row_norm_fourth_sum(T, m, sums['s1'], sums['M2'], sums['q4'], sums['qy'])
+            covariances[rows], _ = _ledoit_wolf_from_moments(T, C2 / T[:, None, None], row_norm_fourth_sum)
+        else:
+            raise ValueError(f"Unknown risk_matrix {risk_matrix!r}")
+    return covariances
+
+# Covariance estimators computed together from shared moments, by risk model name
+ESTIMATORS = ['Sample', 'LedoitWolf+identity', 'LedoitWolf+avgcorr', 'LedoitWolfSkLearn']
+
+def estimator_name(risk_matrix, shrink_target_method=None):
+    """
+    Name of a risk model in the estimators of RiskModel.covariance_estimators, e.g. 'LedoitWolf+avgcorr'
+
+    As shrinkage_covariance, LedoitWolf with any target other than 'identity' (including None) shrinks to 'avgcorr'.
+    """
+    if risk_matrix != 'LedoitWolf':
+        return risk_matrix
+    return 'LedoitWolf+identity' if shrink_target_method == 'identity' else 'LedoitWolf+avgcorr'
+
+def estimators_nbytes(num_assets, dtype=np.float64):
+    """
+    Size in bytes of the ESTIMATORS of one window of num_assets assets, a CovarianceCache entry
+    """
+    return len(ESTIMATORS) * num_assets * num_assets * np.dtype(dtype).itemsize
+
+def _estimators_from_moments(T, cov_var_sample, row_norm_fourth_sum, fourth_moment, third_moment):
+    """
+    The four estimators of ESTIMATORS and their shrinkage intensities from one set of centered moments
+    """
+    covariances, shrinkages = {}, {}
+    covariances['Sample'], shrinkages['Sample'] = cov_var_sample * (T / (T - 1)), None
+    S_hat, _, beta_hat = _shrinkage_from_moments(T, cov_var_sample, 'identity', row_norm_fourth_sum=row_norm_fourth_sum)
+    covariances['LedoitWolf+identity'], shrinkages['LedoitWolf+identity'] = S_hat, beta_hat
+    S_hat, _, beta_hat = _shrinkage_from_moments(T, cov_var_sample, 'avgcorr', fourth_moment=fourth_moment, third_moment=third_moment)
+    covariances['LedoitWolf+avgcorr'], shrinkages['LedoitWolf+avgcorr'] = S_hat, beta_hat
+    covariances['LedoitWolfSkLearn'], shrinkages['LedoitWolfSkLearn'] = _ledoit_wolf_from_moments(T, cov_var_sample, row_norm_fourth_sum)
+    return covariances, shrinkages
+
+class CovarianceCache:
+    """
+    Covariance estimators of (universe, window) keys, shared by the runs of different risk models on the same data
+
+    Entries are only added while their total size stays under max_bytes, so a run that scans more windows than
+    fit keeps the first ones instead of evicting the entries the next run will ask for first.
+    """
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.nbytes = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def accepts(self, num_assets, dtype=np.float64):
+        """
+        Whether put would keep the estimators of num_assets assets, a miss only computes all of them when it does
+        """
+        return self.nbytes + estimators_nbytes(num_assets, dtype) <= self.max_bytes
+
+    def put(self, key, covariances):
+        size = sum(np.asarray(cov).nbytes for cov in covariances.values())
+        if key not in self.entries and self.nbytes + size <= self.max_bytes:
+            self.entries[key] = covariances
+            self.nbytes += size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+class DiskCovarianceCache:
+    """
+    CovarianceCache kept in a directory, one .npy file with the stacked ESTIMATORS of each key
+
+    One process writes the entries (atomically) and the others memory-map them read-only, so the processes of a
+    sweep share one physical copy of the estimators through the page cache instead of each holding its own.
+    Entries are only written while the bytes written by this instance stay under max_bytes.
+    """
+    def __init__(self, directory, max_bytes=1 << 30, read_only=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        stacked = np.load(path, mmap_mode='r')
+        return {name: np.asarray(cov) for name, cov in zip(ESTIMATORS, stacked)}
+
+    def accepts(self, num_assets, dtype=np.float64):
+        """
+        Whether put would write the estimators of num_assets assets (never for a read-only cache)
+        """
+        return not self.read_only and self.nbytes + estimators_nbytes(num_assets, dtype) <= self.max_bytes
+
+    def put(self, key, covariances):
+        path = self._path(key)
+        if self.read_only or os.path.exists(path):
+            return
+        stacked = np.stack([np.asarray(covariances[name]) for name in ESTIMATORS])
+        if self.nbytes + stacked.nbytes > self.max_bytes:
+            return
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, stacked)
+        os.replace(tmp_path, path)
+        self.nbytes += stacked.nbytes
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.nbytes = 0
+
+def _row_blocks(returns, block_size):
+    """
+    Row blocks of an array (T,n) (e.g. np.memmap), block_size rows at a time, or the blocks of an iterable as they come
+    """
+    if hasattr(returns, 'shape'):
+        for start in range(0, returns.shape[0], block_size):
+            yield returns[start:start + block_size]
+    else:
+        yield from returns
+
+def _accumulate(sums, **terms):
+    for key, value in terms.items():
+        sums[key] = sums[key] + value if key in sums else value
+
 class RiskModel:
-    def __init__(self):
-        pass
+    def __init__(self, dtype=np.float64):
+        """
+        :param:
+            dtype: floating point precision of the estimation, np.float64 or np.float32
+                (float32 halves the memory traffic of the (n,n) moment matrices, see Benchmark.benchmark_precision)
+        """
+        self.dtype = np.dtype(dtype)
 
     def shrinkage_covariance(self, returns, shrink_target_method='avgcorr', market_returns=None, cap=None):
         """
         Calculate Shrinkage Estimator of the Covariance Matrix
 
         :param:
-            returns: returns of assets (T,n)
+            returns: returns of assets (T,n), not modified
             shrink_target_method: matrix used in determining shrinkage target
                 'avgcorr':  variance (diagonal) + average correlation * std_i * std_j (off-diagonal)
                 'identity': variance (diagonal) + 0 (off-diagonal)
@@ -22,53 +378,30 @@ class RiskModel:
             betas: market betas for each asset
         """
 
+        returns = np.asarray(returns, dtype=self.dtype)
         T, n = returns.shape
         return_mean = np.mean(returns, axis=0, keepdims=True)
-        returns -= return_mean
+        # centered copy, the caller's array (possibly a read-only view) is never written
+        returns = returns - return_mean
         cov_var_sample = np.matmul(returns.T, returns) / T
-        corr_avg = 0
 
         if shrink_target_method == 'identity':
-            var_mean = np.diag(cov_var_sample).mean()
-            shrink_target = var_mean * np.eye(n)
-
-            omega_hat_squared_sum = 0.0
-            for t in range(T):
-                X_t = returns[t, :].reshape(-1, 1)
-                S_t = np.matmul(X_t, X_t.T)
-                omega_hat_squared_sum += np.linalg.norm(S_t - cov_var_sample, 'fro') ** 2
-            omega_hat_squared = omega_hat_squared_sum / (T * (T - 1))
-
-            beta_hat = 1 - omega_hat_squared / np.linalg.norm(cov_var_sample - shrink_target, 'fro') ** 2
-
+            row_norms_squared = np.einsum('ij,ij->i', returns, returns)
+            S_hat, corr_avg, beta_hat = _shrinkage_from_moments(
+                T, cov_var_sample, shrink_target_method, row_norm_fourth_sum=np.dot(row_norms_squared, row_norms_squared))
         else:
-            std_sample = np.sqrt(np.diag(cov_var_sample).reshape(-1, 1))
-            cov_var_unit = np.matmul(std_sample, std_sample.T)
-            corr_avg = ((cov_var_sample / cov_var_unit).sum() - n) / (n * (n - 1))
-            shrink_target = corr_avg * cov_var_unit
-            np.fill_diagonal(shrink_target, std_sample ** 2)
-
             y = returns ** 2
-            phi_mat = np.matmul(y.T, y) / T - cov_var_sample ** 2
-            phi = phi_mat.sum()
-
-            theta_mat = np.matmul((returns ** 3).T, returns) / T - std_sample ** 2 * cov_var_sample
-            np.fill_diagonal(theta_mat, 0)
-            rho = np.diag(phi_mat).sum() + corr_avg * (1 / np.matmul(std_sample, std_sample.T) * theta_mat).sum()
-
-            gamma = np.linalg.norm(cov_var_sample - shrink_target, "fro") ** 2
-            kappa = (phi - rho) / gamma
-            beta_hat = 1 - max(0, min(1, kappa / T))
-
-        S_hat = (1 - beta_hat) * shrink_target + beta_hat * cov_var_sample
+            S_hat, corr_avg, beta_hat = _shrinkage_from_moments(
+                T, cov_var_sample, shrink_target_method,
+                fourth_moment=np.matmul(y.T, y) / T, third_moment=np.matmul((returns ** 3).T, returns) / T)
 
         # Calculate market returns if not provided, using cap-weighted approach
         if market_returns is None and cap is not None:
             # Normalize market caps to get weights for each time step (T, n)
-            weights = cap / np.sum(cap, axis=1, keepdims=True)  
-            
+            weights = cap / np.sum(cap, axis=1, keepdims=True)
+
             # Compute market returns as a weighted average for each time step (T,)
-            market_returns = np.sum(returns * weights, axis=1)  
+            market_returns = np.sum(returns * weights, axis=1)
 
         # Calculate betas (if market_returns is available)
         if market_returns is not None:
@@ -80,3 +413,378 @@ class RiskModel:
 
         return S_hat, corr_avg, beta_hat, betas
 
+    def covariance_estimators(self, returns):
+        """
+        Sample, Ledoit-Wolf shrinkage ('identity' and 'avgcorr' targets) and sklearn Ledoit-Wolf estimators of the
+        same returns, centering them and forming their cross-products once
+
+        :param:
+            returns: returns of assets (T,n), not modified
+        :return:
+            covariances: dict of the covariance matrices by name (ESTIMATORS), as np.cov, shrinkage_covariance and
+                sklearn's LedoitWolf().fit(returns).covariance_
+            shrinkages: dict of their shrinkage intensities: beta_hat for 'LedoitWolf+...', sklearn's shrinkage_
+                for 'LedoitWolfSkLearn', None for 'Sample'
+        """
+        returns = np.asarray(returns, dtype=self.dtype)
+        T = returns.shape[0]
+        returns = returns - returns.mean(axis=0, keepdims=True)
+        y = returns ** 2
+        row_norms_squared = y.sum(axis=1)
+        return _estimators_from_moments(T, np.matmul(returns.T, returns) / T, np.dot(row_norms_squared, row_norms_squared),
+                                        np.matmul(y.T, y) / T, np.matmul((y * returns).T, returns) / T)
+
+    def blocked_shrinkage_covariance(self, returns, shrink_target_method='avgcorr', market_returns=None, cap=None, block_size=4096):
+        """
+        Shrinkage Estimator of the Covariance Matrix from returns streamed in row blocks, as shrinkage_covariance
+
+        The moments are accumulated block by block (RollingCovariance, in float64) together with the sums needed
+        for the market betas, so memory is bounded by a few (block_size,n) blocks and (n,n) sums whatever T is.
+        The returns are only read, e.g. a read-only np.memmap of minute bars.
+
+        :param:
+            returns: returns of assets (T,n), read block_size rows at a time, or an iterable of (k,n) row blocks
+            shrink_target_method: 'avgcorr' or 'identity'
+            market_returns: Optional, market returns (T,), read along with the rows of returns
+            cap: Optional, market capitalization (T,n) for weighted market return if market_returns is not provided
+            block_size: number of rows read at once from an array
+        :return:
+            S_hat, corr_avg, beta_hat, betas as shrinkage_covariance
+        """
+        moments = None
+        # market sums: with market_returns m_t, sum_t m_t, m_t^2 and y_t m_t; with caps, a_t = y_t . w_t replaces m_t
+        # and the weights enter through sum_t w_t, a_t w_t, w_t w_t' and y_t w_t' (the market of the centered returns)
+        market = {}
+        offset = 0
+        for block in _row_blocks(returns, block_size):
+            block = np.asarray(block, dtype=np.float64)
+            rows = slice(offset, offset + block.shape[0])
+            offset = rows.stop
+            if moments is None:
+                moments = RollingCovariance(block.shape[1], cross_moments=shrink_target_method != 'identity')
+            moments.add(block)
+            y = block - moments.shift
+
+            if market_returns is not None:
+                m = np.asarray(market_returns[rows], dtype=np.float64).ravel()
+                _accumulate(market, Sm=m.sum(), Smm=np.dot(m, m), Sym=np.matmul(m, y))
+            elif cap is not None:
+                cap_block = np.asarray(cap[rows], dtype=np.float64)
+                w = cap_block / cap_block.sum(axis=1, keepdims=True)
+                a = np.einsum('ti,ti->t', y, w)
+                _accumulate(market, Sa=a.sum(), Saa=np.dot(a, a), Sw=w.sum(axis=0), Saw=np.matmul(a, w),
+                            WW=np.matmul(w.T, w), Sya=np.matmul(a, y), YW=np.matmul(y.T, w))
+
+        if moments is None:
+            raise ValueError("returns has no rows")
+        S_hat, corr_avg, beta_hat, _ = moments.shrinkage_covariance(shrink_target_method)
+
+        betas = None
+        if market:
+            T = moments.T
+            mu = moments.s1 / T
+            if 'Sm' in market:
+                market_var = market['Smm'] / T - (market['Sm'] / T) ** 2
+                cov_with_market = (market['Sym'] - mu * market['Sm']) / T
+            else:
+                market_mean = (market['Sa'] - np.dot(mu, market['Sw'])) / T
+                market_var = (market['Saa'] - 2 * np.dot(mu, market['Saw']) + mu @ market['WW'] @ mu) / T - market_mean ** 2
+                cov_with_market = (market['Sya'] - market['YW'] @ mu - mu * market['Sa'] + mu * np.dot(market['Sw'], mu)) / T
+            betas = (cov_with_market / market_var).reshape(-1, 1).astype(self.dtype)
+
+        return S_hat.astype(self.dtype), np.asarray(corr_avg, dtype=self.dtype), np.asarray(beta_hat, dtype=self.dtype), betas
+
+    def factor_covariance(self, returns, num_factors=1, market_returns=None, cap=None):
+        """
+        Calculate a k-Factor Model of the Covariance Matrix, B F B' + D, without forming the n x n matrix
+
+        With market returns (given, or cap-weighted as in shrinkage_covariance) the first factor is the market
+        and its loadings are the market betas; the remaining factors are the principal components of the
+        returns left after the market (all of them if there is no market), from one thin SVD in O(T n min(T, n)).
+
+        :param:
+            returns: returns of assets (T,n), not modified
+            num_factors: number of factors k (including the market)
+            market_returns: Optional, market returns (T,)
+            cap: Optional, market capitalization (T,n) for weighted market return if market_returns is not provided
+        :return:
+            FactorCovariance with the loadings B (n,k), factor covariance F (k,k) and specific variances D (n,)
+        """
+        returns = np.asarray(returns, dtype=self.dtype)
+        T, n = returns.shape
+
+        if market_returns is None and cap is not None:
+            weights = cap / np.sum(cap, axis=1, keepdims=True)
+            market_returns = np.sum(returns * weights, axis=1)
+
+        residuals = returns - returns.mean(axis=0)
+        factor_returns, loadings = [], []
+        if market_returns is not None and num_factors > 0:
+            market = np.asarray(market_returns, dtype=self.dtype).ravel()
+            market = market - market.mean()
+            betas = np.matmul(market, residuals) / np.dot(market, market)
+            residuals -= np.outer(market, betas)
+            factor_returns.append(market[:, None])
+            loadings.append(betas[:, None])
+
+        num_components = min(num_factors - len(loadings), T, n)
+        if num_components > 0:
+            # the principal components are orthogonal to the market, F stays diagonal
+            U, singular_values, Vt = np.linalg.svd(residuals, full_matrices=False)
+            factor_returns.append(U[:, :num_components] * singular_values[:num_components])
+            loadings.append(Vt[:num_components].T)
+            residuals -= np.matmul(factor_returns[-1], Vt[:num_components])
+
+        factor_returns = np.hstack(factor_returns) if factor_returns else np.zeros((T, 0), dtype=self.dtype)
+        loadings = np.hstack(loadings) if loadings else np.zeros((n, 0), dtype=self.dtype)
+        factor_cov = np.matmul(factor_returns.T, factor_returns) / T
+        specific_var = np.einsum('ti,ti->i', residuals, residuals) / T
+
+        # keep D positive for assets fully explained by the factors
+        floor = np.finfo(self.dtype).eps * max(specific_var.max(initial=0), np.einsum('ij,jk,ik->i', loadings, factor_cov, loadings).max(initial=0))
+        return FactorCovariance(loadings, factor_cov, np.maximum(specific_var, floor))
+
+    def batch_shrinkage_covariance(self, returns, windows, shrink_target_method='avgcorr', chunk_size=16):
+        """
+        Shrinkage Estimators of the Covariance Matrix of many row windows of the same returns in one pass,
+        as shrinkage_covariance(returns[start:end], shrink_target_method) for each window
+
+        :param:
+            returns: returns of assets (T,n), not modified
+            windows: sequence of W (start, end) row ranges [start, end) of returns
+            shrink_target_method: 'avgcorr' or 'identity'
+            chunk_size: number of windows whose moments are held in memory at once
+        :return:
+            S_hat: shrinkage estimators of the covariance matrix (W,n,n)
+            corr_avg: sample average correlations (W,)
+            beta_hat: shrinkage slopes (W,)
+        """
+        W, n = len(windows), returns.shape[1]
+        S_hat = np.empty((W, n, n), dtype=self.dtype)
+        corr_avg = np.zeros(W, dtype=self.dtype)
+        beta_hat = np.empty(W, dtype=self.dtype)
+        cross_moments = shrink_target_method != 'identity'
+
+        for rows, sums in window_moments(returns, windows, cross_moments, chunk_size, self.dtype):
+            T = sums['T']
+            m, C2 = _centered_moments(T, sums['s1'], sums['M2'])
+            cov_var_sample = C2 / T[:, None, None]
+
+            if cross_moments:
+                C4, C31 = _centered_cross_moments(T, m, sums['s2'], sums['s3'], sums['M2'], sums['B'], sums['A22'], sums['A31'])
+                S_hat[rows], corr_avg[rows], beta_hat[rows] = _shrinkage_from_moments(
+                    T, cov_var_sample, shrink_target_method,
+                    fourth_moment=C4 / T[:, None, None], third_moment=C31 / T[:, None, None])
+            else:
+                row_norm_fourth_sum = _centered_row_norm_fourth_sum(T, m, sums['s1'], sums['M2'], sums['q4'], sums['qy'])
+                S_hat[rows], corr_avg[rows], beta_hat[rows] = _shrinkage_from_moments(
+                    T, cov_var_sample, shrink_target_method, row_norm_fourth_sum=row_norm_fourth_sum)
+
+        return S_hat, corr_avg, beta_hat
+
+class FactorCovariance:
+    """
+    Covariance matrix B F B' + diag(D) of a k-factor model, kept as its factors
+
+    Memory is O(n k) instead of O(n^2) and matrix-vector products, quadratic forms and solves cost
+    O(n k) / O(n k^2), so the optimizer and assess_portfolio can take it in place of a dense matrix.
+    """
+    def __init__(self, loadings, factor_cov, specific_var):
+        """
+        :param:
+            loadings: factor loadings B (n,k)
+            factor_cov: covariance matrix of the factor returns F (k,k)
+            specific_var: specific (idiosyncratic) variances D (n,)
+        """
+        self.loadings = np.asarray(loadings)
+        self.factor_cov = np.atleast_2d(np.asarray(factor_cov))
+        self.specific_var = np.asarray(specific_var)
+
+    @property
+    def shape(self):
+        n = len(self.specific_var)
+        return n, n
+
+    @property
+    def dtype(self):
+        return self.specific_var.dtype
+
+    def astype(self, dtype):
+        return FactorCovariance(self.loadings.astype(dtype), self.factor_cov.astype(dtype), self.specific_var.astype(dtype))
+
+    def dot(self, x):
+        """
+        (B F B' + D) x for x (n,) or (n,m), as cov_matrix.dot(x) of a dense matrix
+        """
+        factor_x = np.matmul(self.factor_cov, np.matmul(self.loadings.T, x))
+        specific_x = self.specific_var * x if x.ndim == 1 else self.specific_var[:, None] * x
+        return np.matmul(self.loadings, factor_x) + specific_x
+
+    def quad(self, x):
+        """
+        x' (B F B' + D) x, for each row of x if x is (K,n)
+        """
+        exposures = np.matmul(x, self.loadings)
+        return (np.sum(np.matmul(exposures, self.factor_cov) * exposures, axis=-1)
+                + np.sum(self.specific_var * x * x, axis=-1))
+
+    def diagonal(self):
+        return np.einsum('ij,jk,ik->i', self.loadings, self.factor_cov, self.loadings) + self.specific_var
+
+    def submatrix(self, idx):
+        """
+        Covariance matrix of the assets idx, as cov_matrix[np.ix_(idx, idx)] of a dense matrix
+        """
+        return FactorCovariance(self.loadings[idx], self.factor_cov, self.specific_var[idx])
+
+    def solve(self, rhs):
+        """
+        (B F B' + D)^-1 rhs for rhs (n,) or (n,m) by the Woodbury identity, without inverting F
+        """
+        scaled_rhs = rhs / (self.specific_var if rhs.ndim == 1 else self.specific_var[:, None])
+        scaled_loadings = self.loadings / self.specific_var[:, None]
+        k = self.factor_cov.shape[0]
+        # (F^-1 + B' D^-1 B)^-1 = (I + F B' D^-1 B)^-1 F
+        capacitance = np.eye(k, dtype=self.dtype) + np.matmul(self.factor_cov, np.matmul(self.loadings.T, scaled_loadings))
+        correction = np.linalg.solve(capacitance, np.matmul(self.factor_cov, np.matmul(self.loadings.T, scaled_rhs)))
+        return scaled_rhs - np.matmul(scaled_loadings, correction)
+
+    def to_dense(self):
+        """
+        The n x n covariance matrix
+        """
+        dense = np.matmul(self.loadings, np.matmul(self.factor_cov, self.loadings.T))
+        dense[np.diag_indices_from(dense)] += self.specific_var
+        return dense
+
+class RollingCovariance:
+    """
+    Rolling-window covariance estimator
+
+    Keeps the sufficient statistics of the returns in the current window (sums, X'X and, with cross_moments=True,
+    the squared/cubed cross-moments needed by the 'avgcorr' target), so that moving the window costs O(k n^2)
+    for the k rows entering or leaving instead of re-estimating from the whole window.
+    Moments are accumulated around a fixed shift (the mean of the first block added) to limit cancellation.
+    """
+    def __init__(self, n, cross_moments=True):
+        self.n = n
+        self.cross_moments = cross_moments
+        self.shift = None
+        self.start, self.end = 0, 0  # rows of the source array covered by roll_to
+        self._reset()
+
+    def _reset(self):
+        n = self.n
+        self.T = 0
+        self.s1 = np.zeros(n)       # sum_t y_t
+        self.M2 = np.zeros((n, n))  # sum_t y_t y_t'
+        self.q4 = 0.0               # sum_t ||y_t||^4
+        self.qy = np.zeros(n)       # sum_t ||y_t||^2 y_t
+        if self.cross_moments:
+            self.s2 = np.zeros(n)        # sum_t y_t ** 2
+            self.s3 = np.zeros(n)        # sum_t y_t ** 3
+            self.B = np.zeros((n, n))    # (Y ** 2)'Y
+            self.A22 = np.zeros((n, n))  # (Y ** 2)'(Y ** 2)
+            self.A31 = np.zeros((n, n))  # (Y ** 3)'Y
+
+    def _accumulate(self, returns, sign):
+        if self.shift is None:
+            self.shift = returns.mean(axis=0)
+        y = returns - self.shift
+        y2 = y ** 2
+        q = y2.sum(axis=1)
+
+        self.T += sign * y.shape[0]
+        self.s1 += sign * y.sum(axis=0)
+        self.M2 += sign * np.matmul(y.T, y)
+        self.q4 += sign * np.dot(q, q)
+        self.qy += sign * np.matmul(q, y)
+        if self.cross_moments:
+            self.s2 += sign * y2.sum(axis=0)
+            self.s3 += sign * (y2 * y).sum(axis=0)
+            self.B += sign * np.matmul(y2.T, y)
+            self.A22 += sign * np.matmul(y2.T, y2)
+            self.A31 += sign * np.matmul((y2 * y).T, y)
+
+    def add(self, returns):
+        """
+        Add the rows of returns (k,n) to the window
+        """
+        self._accumulate(np.asarray(returns, dtype=np.float64), 1)
+
+    def remove(self, returns):
+        """
+        Remove the rows of returns (k,n), previously added, from the window
+        """
+        self._accumulate(np.asarray(returns, dtype=np.float64), -1)
+
+    def roll_to(self, returns, start, end):
+        """
+        Move the window to the rows [start, end) of returns (T,n), adding and removing only the rows that changed
+        """
+        if start >= self.end or end <= self.start or start < self.start or end < self.end:
+            self._reset()
+            self.shift = None
+            self.add(returns[start:end])
+        else:
+            self.remove(returns[self.start:start])
+            self.add(returns[self.end:end])
+        self.start, self.end = start, end
+
+    def _row_norm_fourth_sum(self, m):
+        return _centered_row_norm_fourth_sum(self.T, m, self.s1, self.M2, self.q4, self.qy)
+
+    def sample_covariance(self):
+        """
+        Sample covariance matrix of the window, as np.cov(returns, rowvar=False)
+        """
+        _, C2 = _centered_moments(self.T, self.s1, self.M2)
+        return C2 / (self.T - 1)
+
+    def shrinkage_covariance(self, shrink_target_method='avgcorr'):
+        """
+        Shrinkage estimator of the window, as RiskModel().shrinkage_covariance(returns, shrink_target_method)
+
+        :return:
+            S_hat, corr_avg, beta_hat, betas (always None)
+        """
+        T = self.T
+        m, C2 = _centered_moments(T, self.s1, self.M2)
+        cov_var_sample = C2 / T
+
+        if shrink_target_method == 'identity':
+            S_hat, corr_avg, beta_hat = _shrinkage_from_moments(
+                T, cov_var_sample, shrink_target_method, row_norm_fourth_sum=self._row_norm_fourth_sum(m))
+        else:
+            if not self.cross_moments:
+                raise ValueError("The 'avgcorr' target requires RollingCovariance(cross_moments=True)")
+
+            C4, C31 = _centered_cross_moments(T, m, self.s2, self.s3, self.M2, self.B, self.A22, self.A31)
+            S_hat, corr_avg, beta_hat = _shrinkage_from_moments(
+                T, cov_var_sample, shrink_target_method, fourth_moment=C4 / T, third_moment=C31 / T)
+
+        return S_hat, corr_avg, beta_hat, None
+
+    def estimators(self):
+        """
+        Every estimator of the window from its moments, as RiskModel().covariance_estimators(returns)
+
+        :return:
+            covariances, shrinkages
+        """
+        if not self.cross_moments:
+            raise ValueError("The estimators require RollingCovariance(cross_moments=True)")
+        T = self.T
+        m, C2 = _centered_moments(T, self.s1, self.M2)
+        C4, C31 = _centered_cross_moments(T, m, self.s2, self.s3, self.M2, self.B, self.A22, self.A31)
+        return _estimators_from_moments(T, C2 / T, self._row_norm_fourth_sum(m), C4 / T, C31 / T)
+
+    def ledoit_wolf(self):
+        """
+        Ledoit-Wolf estimator of the window, as sklearn's LedoitWolf().fit(returns)
+
+        :return:
+            covariance, shrinkage
+        """
+        m, C2 = _centered_moments(self.T, self.s1, self.M2)
+        return _ledoit_wolf_from_moments(self.T, C2 / self.T, self._row_norm_fourth_sum(m))
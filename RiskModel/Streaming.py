@@ -0,0 +1,139 @@
+from collections import deque
+import numpy as np
+import pandas as pd
+from RiskModel import RollingCovariance
+from Optimizer_SR import fit_alloc
+
+class StreamingPortfolio:
+    """
+    Rolling-window risk model and allocation updated one bar at a time
+
+    Each bar's close prices add one return vector to a RollingCovariance (O(n^2)) and, when a new month
+    starts, the returns before the window start leave it. The window matches backtest_portfolio's training
+    window: from the month-end window_size_month months back up to the latest bar. rebalance() re-solves
+    the allocations on the current window, starting from the current ones.
+    """
+    def __init__(self, tickers, risk_matrix='LedoitWolf', shrink_target_method='identity', window_size_month=12, solver='SLSQP'):
+        if risk_matrix not in ('Sample', 'LedoitWolf', 'LedoitWolfSkLearn'):
+            raise ValueError(f"risk_matrix {risk_matrix!r} has no streaming estimator")
+        self.tickers = list(tickers)
+        self.risk_matrix = risk_matrix
+        self.shrink_target_method = shrink_target_method
+        self.window_size_month = window_size_month
+        self.solver = solver
+
+        self.rolling_cov = RollingCovariance(len(self.tickers), cross_moments=(risk_matrix == 'LedoitWolf' and shrink_target_method != 'identity'))
+        self.dates = deque()   # bars of the window, from its start
+        self.prices = deque()
+        self.month_ends = deque(maxlen=window_size_month)
+        self.allocs = None
+
+    @property
+    def ready(self):
+        """
+        Whether the window spans window_size_month full months
+        """
+        return len(self.month_ends) == self.window_size_month
+
+    def update(self, date, prices):
+        """
+        Add the close prices (n,) of the bar at date, later than the previous bar
+        """
+        date = pd.Timestamp(date)
+        prices = np.asarray(prices, dtype=np.float64)
+        if self.dates:
+            last_date = self.dates[-1]
+            if (date.year, date.month) != (last_date.year, last_date.month):
+                self.month_ends.append(last_date)
+                self._evict()
+            self.rolling_cov.add((prices / self.prices[-1] - 1)[None])
+        self.dates.append(date)
+        self.prices.append(prices)
+
+    def _evict(self):
+        """
+        Drop the bars before the window start, and the returns into the bar after each of them
+        """
+        if not self.ready:
+            return
+        while self.dates[0] < self.month_ends[0]:
+            self.dates.popleft()
+            first_prices = self.prices.popleft()
+            self.rolling_cov.remove((self.prices[0] / first_prices - 1)[None])
+
+    def risk(self):
+        """
+        Covariance matrix of the current window
+
+        :return:
+            cov_matrix, shrinkage intensity (beta_hat of RiskModel.shrinkage_covariance for 'LedoitWolf',
+            sklearn's shrinkage_ for 'LedoitWolfSkLearn', None for 'Sample')
+        """
+        if self.risk_matrix == 'Sample':
+            return self.rolling_cov.sample_covariance(), None
+        if self.risk_matrix == 'LedoitWolf':
+            cov_matrix, _, beta_hat, _ = self.rolling_cov.shrinkage_covariance(shrink_target_method=self.shrink_target_method)
+            return cov_matrix, beta_hat
+        return self.rolling_cov.ledoit_wolf()
+
+    def rebalance(self):
+        """
+        Re-solve the allocations on the current window, starting from the current allocations
+
+        As backtest_portfolio on the last trading day of a month, call it before update() with that day's prices.
+
+        :return:
+            allocs, solve info of fit_alloc, shrinkage intensity
+        """
+        cov_matrix, shrinkage = self.risk()
+        train_prices = pd.DataFrame(np.array(self.prices), index=pd.DatetimeIndex(self.dates, name='Date'), columns=self.tickers)
+        self.allocs, solve_info = fit_alloc(train_prices, cov_matrix, solver=self.solver, ini_guess=self.allocs, return_info=True)
+        return self.allocs, solve_info, shrinkage
+
+def replay(path, tickers=None, risk_matrix='LedoitWolf', shrink_target_method='identity', window_size_month=12, solver='SLSQP'):
+    """
+    Feed the close prices of a local CSV file (dates x tickers, e.g. PricePanel.prices.to_csv) to a
+    StreamingPortfolio bar by bar, rebalancing on the last trading day of every month once the window is full
+
+    The holding periods and their returns are those of backtest_portfolio run on the same prices (tickers
+    with missing prices are dropped), from the month-end window_size_month months after the first date.
+
+    :return:
+        DataFrame with one row per rebalance: holding period, its cumulative return, shrinkage intensity,
+        solver iterations and allocations
+    """
+    prices = pd.read_csv(path, index_col=0, parse_dates=True)
+    if tickers is not None:
+        prices = prices[list(tickers)]
+    prices = prices.dropna(axis=1)
+
+    # Last bar of each month; the last bar of the file closes the final holding period
+    months = prices.index.year * 12 + prices.index.month
+    month_end = np.append(months[1:] != months[:-1], True)
+
+    engine = StreamingPortfolio(prices.columns, risk_matrix, shrink_target_method, window_size_month, solver)
+    results = []
+    entry = None
+    for i, (date, bar) in enumerate(zip(prices.index, prices.values)):
+        if month_end[i]:
+            if entry is not None:
+                entry_date, entry_prices = entry
+                results[-1]["Test End"] = engine.dates[-1]
+                results[-1]["Cumulative Return"] = np.dot(engine.allocs, engine.prices[-1] / entry_prices) - 1
+                entry = None
+            if engine.ready and i < len(prices) - 1:
+                allocs, solve_info, shrinkage = engine.rebalance()
+                entry = (date, bar)
+                results.append({
+                    "Test Start": date,
+                    "Test End": date,
+                    "Cumulative Return": 0.0,
+                    "Shrinkage": shrinkage,
+                    "Solver Iterations": solve_info['nit'],
+                    "Optimal Allocations": ", ".join(
+                        f"{ticker}: {alloc:.4f}" for ticker, alloc in sorted(zip(engine.tickers, allocs), key=lambda item: -item[1])
+                        if round(alloc, 4) != 0)
+                })
+        engine.update(date, bar)
+
+    return pd.DataFrame(results)
@@ -0,0 +1,284 @@
+import datetime as dt
+import os
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from threadpoolctl import threadpool_limits
+from DataLoader import PricePanel
+from Optimizer_SR import backtest_portfolio, optimize_portfolio, compute_information_ratio
+from RiskModel import CovarianceCache, DiskCovarianceCache, estimators_nbytes
+
+class SharedPanel(PricePanel):
+    """
+    Read-only (dates x tickers) close price panel in shared memory
+
+    Pickling a SharedPanel only sends the name of the shared memory block and the index,
+    so every worker process reads the same physical copy of the prices.
+    """
+    def __init__(self, prices):
+        values = np.ascontiguousarray(prices.values, dtype=np.float64)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        self._owner = True
+        self.shape = values.shape
+        self.dates = prices.index.values
+        self.tickers = list(prices.columns)
+        np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)[...] = values
+        self._attach()
+
+    def _attach(self):
+        values = np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)
+        values.flags.writeable = False
+        self.prices = pd.DataFrame(values, index=pd.DatetimeIndex(self.dates, name='Date'),
+                                   columns=pd.Index(self.tickers, name='Ticker'), copy=False)
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'shape': self.shape, 'dates': self.dates, 'tickers': self.tickers}
+
+    def __setstate__(self, state):
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self.shape = state['shape']
+        self.dates = state['dates']
+        self.tickers = state['tickers']
+        self._attach()
+
+    def close(self):
+        self.prices = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def grid_configs(tickers, stock_counts, periods, risk_models, shrink_target_methods, benchmark_ticker="SPY", **params):
+    """
+    Configurations of the stock_counts x periods x risk models (x shrink targets for LedoitWolf) grid,
+    each measured against benchmark_ticker (which the sweep's panel must hold)
+    """
+    configs = []
+    for stock_count in stock_counts:
+        for period in periods:
+            for risk_matrix in risk_models:
+                targets = shrink_target_methods if risk_matrix == "LedoitWolf" else [None]
+                for shrink_target_method in targets:
+                    configs.append(dict(params, tickers=tickers[:stock_count], stock_count=stock_count, period=period,
+                                        risk_matrix=risk_matrix, shrink_target_method=shrink_target_method,
+                                        benchmark_ticker=benchmark_ticker))
+    return configs
+
+def describe_config(config):
+    description = f"{config['stock_count']} stocks, {config['period']} periods, {config['risk_matrix']}"
+    if config['shrink_target_method']:
+        description += f", {config['shrink_target_method']}"
+    return description
+
+def rolling_window_task(config, panel):
+    """
+    Rolling window back-test of one configuration (period = window size in months)
+
+    :return:
+        result row, per-window results DataFrame, allocations DataFrame (windows x tickers)
+    """
+    cr, ar, astd, sr, ir, ic, windows, allocations, metrics = backtest_portfolio(
+        config['start_date'], config['end_date'], config['tickers'], config['risk_matrix'], config['shrink_target_method'],
+        config['period'], benchmark_ticker=config['benchmark_ticker'], solver=config.get('solver', 'SLSQP'), panel=panel,
+        return_results=True, reopt_threshold=config.get('reopt_threshold'), reopt_metric=config.get('reopt_metric', 'frobenius'),
+        covariance_cache=_COVARIANCE_CACHE)
+    row = {
+        "Stock Count": config['stock_count'],
+        "Window Period (Months)": config['period'],
+        "Risk Model": config['risk_matrix'],
+        "Shrink Target Method": config['shrink_target_method'] or '',
+        "Cumulative Return": cr,
+        "Average Return": ar,
+        "Standard Deviation": astd,
+        "Sharpe Ratio": sr,
+        "Information Ratio": ir,
+        "Information Coefficient": ic,
+        "Max Drawdown": metrics["Max Drawdown"],
+        "Average Turnover": metrics["Average Turnover"]
+    }
+    if config.get('reopt_threshold') is not None:
+        row["Skipped Solves"] = int((~windows['Reoptimized']).sum())
+    return row, windows, allocations
+
+def in_sample_task(config, panel):
+    """
+    In-sample optimization of one configuration (period = number of years up to end_date)
+
+    :return:
+        result row, None, None (no per-window results or allocations)
+    """
+    end_date = config['end_date']
+    start_date = (dt.datetime.strptime(end_date, "%Y-%m-%d") - pd.DateOffset(years=config['period'])).strftime("%Y-%m-%d")
+    _, _, adr_benchmark, _, _ = optimize_portfolio(start_date, end_date, [config['benchmark_ticker']], panel=panel)
+
+    allocs, cr, adr, sddr, sr, tickers = optimize_portfolio(start_date, end_date, config['tickers'], config['risk_matrix'],
+                                                            shrink_target_method=config['shrink_target_method'], gen_plot=False,
+                                                            solver=config.get('solver', 'SLSQP'), panel=panel,
+                                                            covariance_cache=_COVARIANCE_CACHE, return_tickers=True)
+    ir = compute_information_ratio(adr, adr_benchmark, sddr)
+
+    row = {
+        "Stock Count": config['stock_count'],
+        "Period (Years)": config['period'],
+        "Risk Model": config['risk_matrix'],
+        "Shrink Target Method": config['shrink_target_method'] or '',
+        "Cumulative Return": cr,
+        "Average Daily Return": adr,
+        "Standard Deviation": sddr,
+        "Sharpe Ratio": sr,
+        "Information Ratio": ir,
+        "Optimal Allocations": [
+            f"{ticker}: {alloc:.4f}"
+            for ticker, alloc in zip(tickers, allocs)
+            if round(alloc, 4) != 0
+        ]
+    }
+    return row, None, None
+
+_PANEL = None
+# Covariance estimators shared by the risk models of the (universe, window) group of the running configuration
+_COVARIANCE_CACHE = None
+
+def _init_worker(panel):
+    global _PANEL
+    _PANEL = panel
+    # One BLAS thread per worker, the pool already uses every core
+    threadpool_limits(1)
+
+def _config_group(config):
+    """
+    Configurations with the same tickers, period and dates estimate their covariances on the same windows
+    """
+    return (tuple(config['tickers']), config['period'], config.get('start_date'), config.get('end_date'))
+
+def _estimators_bytes(task, config):
+    """
+    Size of the covariance estimators of every window of a configuration: one window per month of a rolling-window
+    back-test, a single one in-sample
+    """
+    num_windows = 1
+    if task is rolling_window_task:
+        num_windows = len(pd.date_range(config['start_date'], config['end_date'], freq='MS')) + 1
+    return num_windows * estimators_nbytes(len(config['tickers']))
+
+def _run_config(task, config, panel=None, covariance_cache=None):
+    """
+    Run one configuration, its back-test reads and fills covariance_cache
+
+    :return:
+        (result, error message)
+    """
+    global _COVARIANCE_CACHE
+    _COVARIANCE_CACHE = covariance_cache
+    try:
+        return task(config, _PANEL if panel is None else panel), None
+    except Exception as e:
+        return None, str(e)
+    finally:
+        _COVARIANCE_CACHE = None
+
+def run_sweep(task, configs, panel, max_workers=None, store=None, cache_bytes=1 << 30):
+    """
+    Run task(config, panel) for every configuration over a process pool sharing one price panel
+
+    :param:
+        task: function of (config, panel) returning a result row, its per-window results and its allocations
+            (DataFrames or None), e.g. rolling_window_task or in_sample_task
+        configs: list of configurations (see grid_configs)
+        panel: SharedPanel with every ticker and date the configurations need
+        max_workers: number of worker processes (default: number of cores), 1 runs serially in-process
+        store: Optional, ResultsStore.ResultsStore; configurations already in it are not run again and every
+            completed configuration is saved to it as soon as it finishes, so an interrupted sweep resumes
+        cache_bytes: budget of the covariance estimators shared by the risk models of one group, in memory serially
+            and on disk (shared by the workers through the page cache) over the pool
+    The risk models of one group (same tickers, period and dates) estimate their covariances on the same windows.
+    Over the pool, when the estimators of every window of the group fit in cache_bytes, the first one computes them
+    (RiskModel.covariance_estimators) into a cache in a temporary directory (RiskModel.DiskCovarianceCache) and, once
+    it completes, the other risk models of the group run as separate tasks reading the estimators from it; otherwise
+    they all start at once, each estimating its own. Serially, they share an in-memory CovarianceCache.
+    :return:
+        result rows of the configurations that completed (or were already stored), in configuration order
+    """
+    results = [None] * len(configs)
+    pending = []
+    for i, config in enumerate(configs):
+        if store is not None and store.has(task.__name__, config):
+            results[i] = store.get(task.__name__, config)
+        else:
+            pending.append(i)
+    if store is not None:
+        print(f"{len(configs) - len(pending)} of {len(configs)} configurations already in {store.path}")
+
+    def completed(i, result, error):
+        if error is not None:
+            print(f"Error for {describe_config(configs[i])}: {error}")
+            return
+        row, windows, allocations = result
+        results[i] = row
+        if store is not None:
+            store.put(task.__name__, configs[i], row, windows, allocations)
+        print(f"Test completed: {row}")
+
+    groups = {}
+    for i in pending:
+        groups.setdefault(_config_group(configs[i]), []).append(i)
+
+    if max_workers == 1:
+        for group in groups.values():
+            covariance_cache = CovarianceCache(cache_bytes)
+            for i in group:
+                completed(i, *_run_config(task, configs[i], panel, covariance_cache))
+        return [result for result in results if result is not None]
+
+    with tempfile.TemporaryDirectory(prefix='sweep_covariances_') as cache_root, \
+            ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(panel,)) as executor:
+        futures = {}      # future -> (configuration index, cache directory it reads)
+        followers = {}    # configuration index -> (configurations waiting for its estimators, cache directory)
+        readers = {}      # cache directory -> number of configurations still using it
+
+        def submit(i, directory=None, read_only=False):
+            covariance_cache = None if directory is None else DiskCovarianceCache(directory, cache_bytes, read_only=read_only)
+            futures[executor.submit(_run_config, task, configs[i], covariance_cache=covariance_cache)] = (i, directory)
+
+        for number, group in enumerate(groups.values()):
+            # Factor models do not use the cached estimators, a group whose estimators do not fit does not wait for them
+            sharing = [i for i in group if configs[i]['risk_matrix'] != 'Factor']
+            if len(sharing) < 2 or _estimators_bytes(task, configs[sharing[0]]) > cache_bytes:
+                sharing = []
+            for i in group:
+                if i not in sharing:
+                    submit(i)
+            if len(sharing) > 1:
+                directory = os.path.join(cache_root, str(number))
+                readers[directory] = len(sharing)
+                followers[sharing[0]] = (sharing[1:], directory)
+                submit(sharing[0], directory)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, directory = futures.pop(future)
+                try:
+                    result, error = future.result()
+                except Exception as e:
+                    result, error = None, str(e)
+                completed(i, result, error)
+                if i in followers:
+                    waiting, directory = followers.pop(i)
+                    for j in waiting:
+                        submit(j, directory, read_only=True)
+                if directory is not None:
+                    readers[directory] -= 1
+                    if readers[directory] == 0:
+                        shutil.rmtree(directory, ignore_errors=True)
+
+    return [result for result in results if result is not None]
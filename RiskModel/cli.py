@@ -0,0 +1,145 @@
+""" Command-line entry point: python cli.py {in-sample,rolling,sweep} ... """
+
+import argparse
+import datetime as dt
+import os
+
+# Only argparse is imported up front; each command imports what it needs, and sklearn, scipy.optimize,
+# matplotlib and the network modules are only loaded by the code paths that use them.
+
+RISK_MODELS = ["Sample", "LedoitWolf", "LedoitWolfSkLearn", "Factor"]
+
+def _tickers(args):
+    """
+    Tickers of the run: --tickers, else the first --stock-count tickers of the cached universe
+    """
+    if args.tickers:
+        return args.tickers
+    from DataLoader import load_universe
+    universe = load_universe(args.universe, refresh=args.refresh_universe, offline=args.offline)
+    return universe[:args.stock_count] if args.stock_count else universe
+
+def in_sample(args):
+    from Optimizer_SR import optimize_portfolio
+    tickers = _tickers(args)
+    allocs, cr, adr, sddr, sr, tickers = optimize_portfolio(args.start, args.end, tickers, args.risk_matrix, args.shrink_target,
+                                                            gen_plot=args.plot, offline=args.offline, solver=args.solver,
+                                                            return_tickers=True)
+    print(f"Cumulative Return: {cr:.4f}")
+    print(f"Average Daily Return: {adr:.6f}")
+    print(f"Standard Deviation: {sddr:.6f}")
+    print(f"Sharpe Ratio: {sr:.4f}")
+    print("Optimal Allocations: " + ", ".join(
+        f"{ticker}: {alloc:.4f}" for ticker, alloc in sorted(zip(tickers, allocs), key=lambda item: -item[1]) if round(alloc, 4) != 0))
+
+def rolling(args):
+    from Optimizer_SR import backtest_portfolio
+    membership = None
+    if args.membership or args.membership_snapshot:
+        from DataLoader import MEMBERSHIP_FILE, load_membership
+        membership = load_membership(args.membership or MEMBERSHIP_FILE, snapshot=args.membership_snapshot)
+    # With a membership table and no --tickers, every ticker that was ever a member is a candidate
+    tickers = membership.tickers if membership is not None and not args.tickers else _tickers(args)
+    backtest_portfolio(args.start, args.end, tickers, args.risk_matrix, args.shrink_target, args.window, args.step,
+                       benchmark_ticker=args.benchmark, offline=args.offline, solver=args.solver, batch_cov=args.batch_cov,
+                       reopt_threshold=args.reopt_threshold, reopt_metric=args.reopt_metric, membership=membership,
+                       warm_start=args.warm_start, window_workers=args.window_workers, window_executor=args.window_executor)
+
+def sweep(args):
+    import pandas as pd
+    from ResultsStore import ResultsStore
+    from Sweep import SharedPanel, grid_configs, in_sample_task, rolling_window_task, run_sweep
+
+    tickers = _tickers(args)
+    stock_counts = args.stock_counts or [len(tickers)]
+    if args.mode == 'rolling':
+        task = rolling_window_task
+        # Every ticker of the grid is loaded once, from the start of the longest training window
+        panel_start = dt.datetime.strptime(args.start, "%Y-%m-%d") - pd.DateOffset(months=max(args.periods))
+        reopt = dict(reopt_threshold=args.reopt_threshold, reopt_metric=args.reopt_metric) if args.reopt_threshold is not None else {}
+        configs = grid_configs(tickers, stock_counts, args.periods, args.risk_models, args.targets, benchmark_ticker=args.benchmark,
+                               start_date=args.start, end_date=args.end, solver=args.solver, **reopt)
+        output = "result/backtesting_result_summary_rolling_window.csv"
+    else:
+        task = in_sample_task
+        panel_start = dt.datetime.strptime(args.end, "%Y-%m-%d") - pd.DateOffset(years=max(args.periods))
+        configs = grid_configs(tickers, stock_counts, args.periods, args.risk_models, args.targets, benchmark_ticker=args.benchmark,
+                               end_date=args.end, solver=args.solver)
+        output = "result/portfolio_optimization_results_in-sample.csv"
+
+    with SharedPanel.load(tickers[:max(stock_counts)] + [args.benchmark], panel_start.strftime("%Y-%m-%d"), args.end,
+                          offline=args.offline) as panel, ResultsStore(args.store) as store:
+        results = run_sweep(task, configs, panel, max_workers=args.workers, store=store, cache_bytes=args.cache_mb << 20)
+
+    df_results = pd.DataFrame(results)
+    if args.mode == 'in-sample' and not df_results.empty:
+        df_results["Optimal Allocations"] = df_results["Optimal Allocations"].apply(
+            lambda x: ", ".join(sorted(x, key=lambda alloc: float(alloc.split(": ")[1]), reverse=True)))
+    df_results.to_csv(output, index=False)
+    print(f"All tests completed. Results saved to '{output}'")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Sharpe ratio portfolio optimization with shrinkage risk models")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--tickers', nargs='+', help="tickers to use instead of the universe")
+    common.add_argument('--stock-count', type=int, help="use the first N tickers of the universe")
+    common.add_argument('--universe', default=None, help="cached universe file (default: data_cache/sp500_tickers.json)")
+    common.add_argument('--refresh-universe', action='store_true', help="scrape the universe again and update the cached file")
+    common.add_argument('--offline', action='store_true', help="serve prices and the universe from the local cache only")
+    common.add_argument('--solver', default='SLSQP', choices=['SLSQP', 'QP'])
+    common.add_argument('--benchmark', default='SPY')
+    common.add_argument('--end', default='2024-12-31')
+
+    single = argparse.ArgumentParser(add_help=False)
+    single.add_argument('--risk-matrix', default='Sample', choices=RISK_MODELS)
+    single.add_argument('--shrink-target', default=None, choices=['identity', 'avgcorr'])
+
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    reopt = argparse.ArgumentParser(add_help=False)
+    reopt.add_argument('--reopt-threshold', type=float, help="keep the last allocations while the estimates drift less than this")
+    reopt.add_argument('--reopt-metric', default='frobenius', choices=['frobenius', 'sharpe'])
+
+    command = commands.add_parser('in-sample', parents=[common, single], help="optimize the allocation over one period")
+    command.add_argument('--start', default='2021-01-01')
+    command.add_argument('--plot', action='store_true')
+    command.set_defaults(run=in_sample)
+
+    command = commands.add_parser('rolling', parents=[common, single, reopt], help="rolling window back-test")
+    command.add_argument('--start', default='2014-12-31')
+    command.add_argument('--window', type=int, default=12, help="training window in months")
+    command.add_argument('--step', type=int, default=1, help="rebalance step in months")
+    command.add_argument('--batch-cov', action='store_true', help="estimate every window's covariance in one batched pass")
+    command.add_argument('--membership', help="point-in-time membership table (default: data_cache/sp500_membership.csv "
+                                               "when --membership-snapshot is given)")
+    command.add_argument('--membership-snapshot', help="rebuild the membership table from a saved Wikipedia HTML page or CSV")
+    command.add_argument('--no-warm-start', dest='warm_start', action='store_false',
+                         help="solve every window from equal weights instead of the previous window's allocations")
+    command.add_argument('--window-workers', type=int, help="solve the windows over a pool of N workers (needs --no-warm-start)")
+    command.add_argument('--window-executor', default='process', choices=['process', 'thread'])
+    command.set_defaults(run=rolling)
+
+    command = commands.add_parser('sweep', parents=[common, reopt], help="grid of back-tests over a process pool, resumable")
+    command.add_argument('mode', choices=['rolling', 'in-sample'])
+    command.add_argument('--start', default='2014-12-31', help="first test date of the rolling mode")
+    command.add_argument('--stock-counts', type=int, nargs='+')
+    command.add_argument('--periods', type=int, nargs='+', default=[12, 24, 36, 60],
+                         help="window sizes in months (rolling) or periods in years (in-sample)")
+    command.add_argument('--risk-models', nargs='+', default=["Sample", "LedoitWolf", "LedoitWolfSkLearn"], choices=RISK_MODELS)
+    command.add_argument('--targets', nargs='+', default=["identity", "avgcorr"], choices=['identity', 'avgcorr'])
+    command.add_argument('--workers', type=int, default=os.cpu_count())
+    command.add_argument('--store', default="result/results.sqlite", help="SQLite results store")
+    command.add_argument('--cache-mb', type=int, default=1024,
+                         help="budget in MB of the covariance estimators shared by the risk models of one universe and window")
+    command.set_defaults(run=sweep)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.universe is None:
+        from DataLoader import UNIVERSE_FILE
+        args.universe = UNIVERSE_FILE
+    args.run(args)
+
+if __name__ == "__main__":
+    main()